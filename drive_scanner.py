@@ -2,7 +2,9 @@
 
 import os
 import re
-from typing import List, Dict
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
 
 import google.auth
 from google.oauth2 import service_account
@@ -10,9 +12,67 @@ from googleapiclient.discovery import build
 
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
 
+IMAGE_MIME_TYPES = frozenset({
+    'image/jpeg',
+    'image/jpg',
+    'image/png',
+    'image/gif',
+    'image/webp',
+    'image/bmp',
+    'image/svg+xml',
+})
+# フォルダごとに組み立て直さないよう、MIME条件のクエリ文字列はimport時に一度だけ生成する
+_IMAGE_MIME_QUERY = ' or '.join(f"mimeType='{mime}'" for mime in sorted(IMAGE_MIME_TYPES))
+_FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+_FOLDER_MIME_QUERY = f"mimeType='{_FOLDER_MIME_TYPE}'"
+# サブフォルダと画像を1回の問い合わせで取得するための条件
+_FOLDER_OR_IMAGE_MIME_QUERY = f"{_FOLDER_MIME_QUERY} or {_IMAGE_MIME_QUERY}"
+_IMAGE_FIELDS = "id, name, webViewLink, mimeType, size, md5Checksum"
+
+# 1回のfiles.listで `'<id>' in parents` をまとめて問い合わせるフォルダ数
+FOLDER_QUERY_BATCH_SIZE = 25
+# files.listを並行して発行するスレッド数
+DRIVE_LIST_WORKERS = int(os.getenv("DRIVE_LIST_WORKERS", "8") or "8")
+# Drive APIのリクエストが429/5xxやレート制限の403で失敗した場合に、指数バックオフで再試行する回数
+DRIVE_NUM_RETRIES = max(0, int(os.getenv("DRIVE_NUM_RETRIES", "5") or "5"))
+
+
+# 認証情報とスレッドプールは走査のたびに作り直さず、プロセス内で使い回す
+_credentials = None
+_list_pool: Optional[ThreadPoolExecutor] = None
+_thread_local = threading.local()
+
+
+def get_thread_drive_service(creds):
+    """
+    呼び出し元スレッド専用のDriveサービスを返す。
+    googleapiclientのHTTPクライアントはスレッドセーフではないためスレッドごとに作り、
+    同じスレッドでは使い回してTLS接続（keep-alive）を再利用する。
+    """
+    cached = getattr(_thread_local, "drive_service", None)
+    if cached is not None and cached[0] is creds:
+        return cached[1]
+    drive_service = build('drive', 'v3', credentials=creds, cache_discovery=False)
+    _thread_local.drive_service = (creds, drive_service)
+    return drive_service
+
+
+def _get_list_pool() -> ThreadPoolExecutor:
+    global _list_pool
+    if _list_pool is None:
+        _list_pool = ThreadPoolExecutor(max_workers=max(1, DRIVE_LIST_WORKERS), thread_name_prefix="drive-list")
+    return _list_pool
+
 
 def _get_google_credentials():
-    """実行環境に応じてGoogle Drive API用の認証情報を返す。"""
+    """実行環境に応じてGoogle Drive API用の認証情報を返す（初回のみ取得）。"""
+    global _credentials
+    if _credentials is None:
+        _credentials = _load_google_credentials()
+    return _credentials
+
+
+def _load_google_credentials():
     environment = os.getenv("ENVIRONMENT", "local")
     if environment == "production":
         creds, _ = google.auth.default(scopes=SCOPES)
@@ -39,54 +99,84 @@ def extract_folder_id(id_or_url: str) -> str:
     return id_or_url
 
 
-def list_files_in_drive_folder(drive_url: str) -> List[Dict]:
-    """指定フォルダ配下の全サブフォルダを走査し、画像ファイル情報を収集する。"""
-    creds = _get_google_credentials()
-    drive_service = build('drive', 'v3', credentials=creds)
-    folder_id = extract_folder_id(drive_url)
-
-    folders_to_check = [{'id': folder_id, 'path': ''}]
-    all_folders = list(folders_to_check)
-    while folders_to_check:
-        current_folder = folders_to_check.pop(0)
-        query = f"'{current_folder['id']}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
+def _list_children(drive_service, parent_ids: List[str], mime_query: str, fields: str) -> List[Dict]:
+    """parent_idsのいずれかを親に持つファイルを、ページングしながらすべて取得する。"""
+    parents_query = ' or '.join(f"'{parent_id}' in parents" for parent_id in parent_ids)
+    query = f"({parents_query}) and ({mime_query}) and trashed=false"
+    items: List[Dict] = []
+    page_token = None
+    while True:
         results = drive_service.files().list(
             q=query,
-            fields="files(id, name)",
+            fields=f"nextPageToken, files({fields}, parents)",
+            pageSize=1000,
+            pageToken=page_token,
             supportsAllDrives=True,
             includeItemsFromAllDrives=True
-        ).execute()
-        for subfolder in results.get('files', []):
-            folder_path = f"{current_folder['path']}/{subfolder['name']}" if current_folder['path'] else subfolder['name']
-            folder_info = {'id': subfolder['id'], 'path': folder_path}
-            all_folders.append(folder_info)
-            folders_to_check.append(folder_info)
-
-    image_mime_types = [
-        'image/jpeg',
-        'image/jpg',
-        'image/png',
-        'image/gif',
-        'image/webp',
-        'image/bmp',
-        'image/svg+xml'
-    ]
-    mime_query = ' or '.join([f"mimeType='{mime}'" for mime in image_mime_types])
+        ).execute(num_retries=DRIVE_NUM_RETRIES)
+        items.extend(results.get('files', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return items
+
+
+def _list_children_of_folders(
+    creds,
+    folders: List[Dict],
+    mime_query: str,
+    fields: str,
+) -> List[Tuple[Dict, Dict]]:
+    """
+    複数フォルダの子要素を、FOLDER_QUERY_BATCH_SIZE件ずつまとめたクエリを並行発行して取得する。
+    戻り値は (親フォルダ情報, 子要素) の組のリスト。いずれかのクエリが失敗した場合は例外をそのまま送出する。
+    """
+    folders_by_id = {folder['id']: folder for folder in folders}
+    folder_ids = list(folders_by_id)
+    chunks = [folder_ids[i:i + FOLDER_QUERY_BATCH_SIZE] for i in range(0, len(folder_ids), FOLDER_QUERY_BATCH_SIZE)]
+
+    def run(chunk: List[str]):
+        return chunk, _list_children(get_thread_drive_service(creds), chunk, mime_query, fields)
+
+    pairs: List[Tuple[Dict, Dict]] = []
+    for chunk, items in _get_list_pool().map(run, chunks):
+        chunk_ids = set(chunk)
+        for item in items:
+            parents = item.pop('parents', [])
+            for parent_id in parents:
+                if parent_id in chunk_ids:
+                    pairs.append((folders_by_id[parent_id], dict(item)))
+    return pairs
+
+
+def list_files_in_drive_folder(drive_url: str) -> List[Dict]:
+    """
+    指定フォルダ配下の全サブフォルダを走査し、画像ファイル情報を収集する。
+    フォルダ階層は1段ずつ幅優先でたどり、同じ段のフォルダはまとめて問い合わせるため、
+    API呼び出しの待ち時間はフォルダ数ではなく階層の深さにおおむね比例する。
+    各段ではサブフォルダと画像を同じ問い合わせで取得し、画像だけを取り直す走査は行わない。
+    一部のフォルダの取得に失敗した場合は、そのフォルダの画像が削除されたと誤って判定されないよう例外にする。
+    """
+    creds = _get_google_credentials()
+    folder_id = extract_folder_id(drive_url)
 
+    current_level = [{'id': folder_id, 'path': ''}]
+    # 複数の親を持つフォルダを二重に走査しないよう、訪問済みのIDを集合で管理する
+    visited_ids = {folder_id}
     all_images = []
-    for folder in all_folders:
-        try:
-            query = f"'{folder['id']}' in parents and ({mime_query}) and trashed=false"
-            results = drive_service.files().list(
-                q=query,
-                fields="files(id, name, webViewLink, mimeType)",
-                supportsAllDrives=True,
-                includeItemsFromAllDrives=True
-            ).execute()
-            for image in results.get('files', []):
-                image['folder_path'] = folder['path']
-                all_images.append(image)
-        except Exception as exc:
-            print(f"⚠️ フォルダ '{folder['path'] or 'root'}' (ID: {folder['id']}) の走査に失敗しました: {exc}")
+    while current_level:
+        next_level = []
+        for parent, child in _list_children_of_folders(
+            creds, current_level, _FOLDER_OR_IMAGE_MIME_QUERY, _IMAGE_FIELDS
+        ):
+            if child.get('mimeType') != _FOLDER_MIME_TYPE:
+                child['folder_path'] = parent['path']
+                all_images.append(child)
+                continue
+            if child['id'] in visited_ids:
+                continue
+            visited_ids.add(child['id'])
+            folder_path = f"{parent['path']}/{child['name']}" if parent['path'] else child['name']
+            next_level.append({'id': child['id'], 'path': folder_path})
+        current_level = next_level
 
     return all_images
@@ -4,6 +4,7 @@ Google Driveの変更通知チャネルを管理し、通知に応じてベク
 
 import json
 import os
+import threading
 import time
 from typing import Any, Dict, List, Optional, Set
 from uuid import uuid4
@@ -15,6 +16,7 @@ from googleapiclient.errors import HttpError
 from google.cloud import storage
 
 from drive_scanner import extract_folder_id
+from embedding_store import delete_store
 
 DRIVE_SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
 DEFAULT_KEY_FILE = os.getenv("SERVICE_ACCOUNT_FILE", "marketing-automation-461305-2acf4965e0b0.json")
@@ -42,6 +44,15 @@ def _build_storage_client():
     return storage.Client()
 
 
+def _get_start_page_token(drive_service, drive_id: Optional[str]) -> str:
+    """Drive変更一覧の開始トークンを取得する。共有ドライブの場合はdrive_idを指定する。"""
+    params: Dict[str, Any] = {"supportsAllDrives": True}
+    if drive_id:
+        params["driveId"] = drive_id
+    response = drive_service.changes().getStartPageToken(**params).execute()
+    return response["startPageToken"]
+
+
 class DriveWatchStateStore:
     """GCS上にDrive変更監視チャネルと企業設定の状態を保存・管理する。"""
 
@@ -175,13 +186,6 @@ class DriveWatchManager:
         # drive_service: Drive APIのクライアントを作成する。
         self.drive_service = build("drive", "v3", credentials=_build_drive_credentials(), cache_discovery=False)
 
-    def _get_start_page_token(self, drive_id: Optional[str]) -> str:
-        params: Dict[str, Any] = {"supportsAllDrives": True}
-        if drive_id:
-            params["driveId"] = drive_id
-        response = self.drive_service.changes().getStartPageToken(**params).execute()
-        return response["startPageToken"]
-
     def create_watch(
         self,
         uuid: str,
@@ -269,7 +273,7 @@ class DriveWatchManager:
             existing["is_new_channel"] = False
             return existing
 
-        start_page_token = self._get_start_page_token(drive_id)
+        start_page_token = _get_start_page_token(self.drive_service, drive_id)
         channel_id = str(uuid4())
         watch_body: Dict[str, Any] = {
             "id": channel_id,
@@ -374,11 +378,7 @@ class DriveWatchManager:
     def delete_embedding_data(self, uuid: str) -> bool:
         client = _build_storage_client()
         bucket = client.bucket(self.bucket_name)
-        blob = bucket.blob(f"{uuid}.json")
-        if blob.exists():
-            blob.delete()
-            return True
-        return False
+        return delete_store(bucket, uuid)
 
 
 class DriveNotificationProcessor:
@@ -390,6 +390,7 @@ class DriveNotificationProcessor:
         job_service,
         cooldown_seconds: Optional[int] = None,
         verbose_logging: Optional[bool] = None,
+        debounce_seconds: Optional[float] = None,
     ):
         if not bucket_name:
             raise ValueError("bucket_name is required.")
@@ -403,6 +404,16 @@ class DriveNotificationProcessor:
         self.cooldown_seconds = cooldown_seconds if cooldown_seconds is not None else derived_cooldown
         if self.cooldown_seconds < 0:
             self.cooldown_seconds = 0
+        default_debounce = os.getenv("DRIVE_WATCH_DEBOUNCE_SECONDS", "").strip()
+        derived_debounce = float(default_debounce or "1.0")
+        self.debounce_seconds = debounce_seconds if debounce_seconds is not None else derived_debounce
+        if self.debounce_seconds < 0:
+            self.debounce_seconds = 0
+        # channel_id -> 待機中の通知の受付件数。先頭の通知が待機を終えて変更フィードを読むまでの間だけ存在する
+        self._pending_notifications: Dict[str, int] = {}
+        self._pending_lock = threading.Lock()
+        # 変更フィードの読み出しとページトークンの更新を直列化し、同じトークンを二重に読まないようにする
+        self._feed_lock = threading.Lock()
         env_verbose = os.getenv("DRIVE_WATCH_VERBOSE_LOGS", "true").strip().lower() not in {"false", "0", "no"}
         self.verbose_logging = env_verbose if verbose_logging is None else verbose_logging
 
@@ -441,7 +452,31 @@ class DriveNotificationProcessor:
             self._log(f"ℹ️  No registered companies for drive {drive_id}.")
             return {"handled": True, "changes_found": 0, "job_triggered": False, "status": "no_companies"}
 
-        changes = self._consume_drive_change_feed(drive_state)
+        if self.debounce_seconds:
+            # 1回の保存でも複数の通知がほぼ同時に届くため、窓の終わりにまとめて1回だけ変更フィードを読む（後縁デバウンス）。
+            # 最初の通知が窓の間待機してから読み、窓の中で届いた通知はその読み出しに合流させる。
+            # 読み出しを始めた後に届いた通知は新しい窓を開くため、未読のページトークンは残らない
+            with self._pending_lock:
+                pending = self._pending_notifications.get(channel_id)
+                if pending is not None:
+                    self._pending_notifications[channel_id] = pending + 1
+                    self._log(
+                        f"🔇 Debounced notification for drive {drive_id}: "
+                        f"coalesced into the pending change feed read (window {self.debounce_seconds}s)."
+                    )
+                    return {"handled": True, "changes_found": 0, "job_triggered": False, "status": "debounced"}
+                self._pending_notifications[channel_id] = 1
+            time.sleep(self.debounce_seconds)
+            with self._pending_lock:
+                coalesced = self._pending_notifications.pop(channel_id, 1)
+            if coalesced > 1:
+                self._log(f"📦 Coalesced {coalesced} notification(s) for drive {drive_id} into one change feed read.")
+
+        with self._feed_lock:
+            # 待機中に別の読み出しがページトークンを進めている場合があるため、最新の状態を読み直す
+            drive_state = self.store.find_drive_state_by_channel_id(channel_id) or drive_state
+            company_states = self.store.list_company_states(drive_id)
+            changes = self._consume_drive_change_feed(drive_state)
         matches = self._match_changes_to_companies(changes, company_states)
         if not matches:
             self._log(f"ℹ️  No relevant changes found for drive {drive_id}.")
@@ -492,7 +527,7 @@ class DriveNotificationProcessor:
     def _consume_drive_change_feed(self, drive_state: Dict[str, Any]) -> List[Dict[str, Any]]:
         token = drive_state.get("page_token")
         if not token:
-            token = self._get_start_page_token(drive_state.get("drive_id"))
+            token = _get_start_page_token(self.drive_service, drive_state.get("drive_id"))
 
         aggregated: List[Dict[str, Any]] = []
         current_token = token
@@ -505,7 +540,7 @@ class DriveNotificationProcessor:
                 status = getattr(exc.resp, "status", None)
                 if status == 410:
                     print("⚠️  Stored page token expired for drive channel. Resetting to latest start token.")
-                    new_token = self._get_start_page_token(drive_state.get("drive_id"))
+                    new_token = _get_start_page_token(self.drive_service, drive_state.get("drive_id"))
                     drive_state["page_token"] = new_token
                     self.store.save_drive_state(drive_state)
                     return []
@@ -556,13 +591,6 @@ class DriveNotificationProcessor:
             params["driveId"] = drive_id
         return self.drive_service.changes().list(**params).execute()
 
-    def _get_start_page_token(self, drive_id: Optional[str]) -> str:
-        params: Dict[str, Any] = {"supportsAllDrives": True}
-        if drive_id:
-            params["driveId"] = drive_id
-        response = self.drive_service.changes().getStartPageToken(**params).execute()
-        return response["startPageToken"]
-
     def _filter_relevant_changes(self, changes: List[Dict[str, Any]], folder_id: str) -> List[Dict[str, Any]]:
         relevant: List[Dict[str, Any]] = []
         for change in changes:
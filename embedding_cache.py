@@ -0,0 +1,202 @@
+"""
+画像の内容をキーにした埋め込みベクトルのキャッシュ。
+
+同じ画像を別のフォルダや別のUUIDで再処理する場合に、埋め込みAPIの呼び出しを省略するために使う。
+キーは「モデル識別子・画像データのハッシュ（file_hash）・ファイル名」から作る。ファイル名も重み付けに使われるため、
+画像が同じでもファイル名が異なれば別のエントリとして扱う。
+ファイル名だけの埋め込み（テキスト側）も、別のキー（make_text_cache_key）で同じファイルに保存する。
+また、DriveのMD5チェックサムからfile_hashを引く対応表も保存し、内容が既知のファイルはダウンロードせずにキーを作れるようにする。
+
+キャッシュはSQLiteファイルとしてローカルに保存し、必要に応じてGCS上のオブジェクトと同期する。
+複数のジョブが同じオブジェクトを同時に更新しても互いのエントリを消さないよう、アップロードは世代番号を条件に行い、
+競合した場合はGCS側のエントリを取り込んでから再試行する。
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from google.api_core.exceptions import PreconditionFailed
+
+CACHE_DTYPE = np.float32
+UPLOAD_MAX_ATTEMPTS = 3
+QUERY_BATCH_SIZE = 500
+
+
+def make_cache_key(model_id: str, file_hash: str, filename: str) -> str:
+    """モデル識別子・画像データのハッシュ・ファイル名からキャッシュキーを作る。"""
+    return hashlib.sha256(f"{model_id}\0{file_hash}\0{filename}".encode("utf-8")).hexdigest()
+
+
+def make_text_cache_key(model_id: str, text: str) -> str:
+    """テキスト（ファイル名）単体の埋め込み用のキャッシュキーを作る。画像のキーと衝突しないよう種別を含める。"""
+    return hashlib.sha256(f"text\0{model_id}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """SQLiteに key -> float32ベクトル を保存するキャッシュ。"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_hashes (checksum TEXT PRIMARY KEY, file_hash TEXT NOT NULL)"
+        )
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+        # 最後にGCSから取得した（またはアップロードした）オブジェクトの世代。0はオブジェクトが無いことを表す
+        self.remote_generation = 0
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """キーに対応するベクトルを返す。存在しない場合はNone。"""
+        with self._lock:
+            row = self._conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.frombuffer(row[0], dtype=CACHE_DTYPE)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, np.ndarray]:
+        """複数のキーをまとめて引き、見つかったキーとベクトルの辞書を返す。ヒット数の集計には含めない。"""
+        keys = list(dict.fromkeys(keys))
+        found: Dict[str, np.ndarray] = {}
+        with self._lock:
+            # SQLiteのバインド変数の上限（既定999）を超えないよう分割して問い合わせる
+            for start in range(0, len(keys), QUERY_BATCH_SIZE):
+                chunk = keys[start:start + QUERY_BATCH_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=CACHE_DTYPE)
+        return found
+
+    def put_many(self, items: Iterable[Tuple[str, np.ndarray]]) -> None:
+        """(キー, ベクトル) の組をまとめて保存する。"""
+        rows: List[Tuple[str, bytes]] = [
+            (key, np.asarray(vector, dtype=CACHE_DTYPE).tobytes())
+            for key, vector in items
+        ]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+            self._conn.commit()
+
+    def get_file_hashes(self, checksums: Iterable[str]) -> Dict[str, str]:
+        """Driveのチェックサムに対応するfile_hashをまとめて引き、見つかったものの辞書を返す。"""
+        checksums = list(dict.fromkeys(checksums))
+        found: Dict[str, str] = {}
+        with self._lock:
+            for start in range(0, len(checksums), QUERY_BATCH_SIZE):
+                chunk = checksums[start:start + QUERY_BATCH_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT checksum, file_hash FROM file_hashes WHERE checksum IN ({placeholders})", chunk
+                ).fetchall()
+                found.update(rows)
+        return found
+
+    def put_file_hashes(self, items: Iterable[Tuple[str, str]]) -> None:
+        """(Driveのチェックサム, file_hash) の組をまとめて保存する。"""
+        rows = list(items)
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO file_hashes (checksum, file_hash) VALUES (?, ?)", rows)
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def merge_from(self, path: str) -> None:
+        """別のキャッシュファイルのエントリのうち、手元に無いものを取り込む。"""
+        with self._lock:
+            self._conn.execute("ATTACH DATABASE ? AS remote", (path,))
+            try:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO embeddings (key, vector) SELECT key, vector FROM remote.embeddings"
+                )
+                # 対応表を持たない以前のキャッシュファイルも取り込めるよう、テーブルがある場合だけ取り込む
+                has_file_hashes = self._conn.execute(
+                    "SELECT 1 FROM remote.sqlite_master WHERE type = 'table' AND name = 'file_hashes'"
+                ).fetchone()
+                if has_file_hashes:
+                    self._conn.execute(
+                        "INSERT OR IGNORE INTO file_hashes (checksum, file_hash) SELECT checksum, file_hash FROM remote.file_hashes"
+                    )
+                self._conn.commit()
+            finally:
+                self._conn.execute("DETACH DATABASE remote")
+
+    def _merge_remote(self, bucket, blob_name: str) -> None:
+        """GCS上の最新のキャッシュを取り込み、その世代を記録する。"""
+        blob = bucket.blob(blob_name)
+        temp_path = f"{self.path}.remote"
+        try:
+            blob.download_to_filename(temp_path)
+            self.merge_from(temp_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.remote_generation = blob.generation or 0
+
+    def upload(self, bucket, blob_name: str) -> None:
+        """
+        キャッシュファイルをGCSへアップロードする。
+        取得後に他のジョブがオブジェクトを更新していた場合は、そのエントリを取り込んでからアップロードし直す。
+        """
+        for _ in range(UPLOAD_MAX_ATTEMPTS):
+            with self._lock:
+                self._conn.commit()
+            blob = bucket.blob(blob_name)
+            try:
+                blob.upload_from_filename(
+                    self.path,
+                    content_type="application/vnd.sqlite3",
+                    if_generation_match=self.remote_generation,
+                )
+            except PreconditionFailed:
+                self._merge_remote(bucket, blob_name)
+                continue
+            self.remote_generation = blob.generation or 0
+            return
+        raise RuntimeError(f"Embedding cache upload kept conflicting after {UPLOAD_MAX_ATTEMPTS} attempts")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def open_cache(path: str, bucket=None, blob_name: Optional[str] = None) -> EmbeddingCache:
+    """
+    キャッシュを開く。bucketとblob_nameが指定され、ローカルにファイルが無い場合はGCSから取得する。
+    """
+    if bucket is None or not blob_name:
+        return EmbeddingCache(path)
+    if os.path.exists(path):
+        # ローカルにファイルがある場合も、GCS側の更新分は取り込んでおく
+        cache = EmbeddingCache(path)
+        blob = bucket.blob(blob_name)
+        if blob.exists():
+            cache._merge_remote(bucket, blob_name)
+        return cache
+    blob = bucket.blob(blob_name)
+    generation = 0
+    if blob.exists():
+        blob.download_to_filename(path)
+        generation = blob.generation or 0
+    cache = EmbeddingCache(path)
+    cache.remote_generation = generation
+    return cache
+
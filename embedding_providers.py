@@ -1,9 +1,18 @@
 import base64
+import contextlib
 import inspect
+import io
 import os
+import random
+import re
 import tempfile
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Optional, Dict
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import Callable, Optional, Dict, Iterator, List, Mapping, Tuple
 
 import numpy as np
 
@@ -12,6 +21,25 @@ try:
 except ImportError:  # pragma: no cover
     cohere = None
 
+try:
+    import httpx  # type: ignore
+except ImportError:  # pragma: no cover
+    httpx = None
+
+try:
+    import torch  # type: ignore
+    import open_clip  # type: ignore
+    from PIL import Image as PILImage
+except ImportError:  # pragma: no cover
+    torch = None
+    open_clip = None
+    PILImage = None
+
+try:
+    import pybase64  # type: ignore
+except ImportError:  # pragma: no cover
+    pybase64 = None
+
 try:
     import vertexai  # type: ignore
     from vertexai.preview.vision_models import MultiModalEmbeddingModel, Image as VertexImage  # type: ignore
@@ -21,6 +49,45 @@ except ImportError:  # pragma: no cover
     VertexImage = None
 
 
+# Cohere Embed APIの1リクエストあたりの入力上限（テキストは96件、画像は1件）
+COHERE_MAX_TEXTS_PER_REQUEST = 96
+COHERE_MAX_IMAGES_PER_REQUEST = int(os.getenv("COHERE_MAX_IMAGES_PER_REQUEST", "1") or "1")
+COHERE_MAX_CONCURRENT_REQUESTS = int(os.getenv("COHERE_MAX_CONCURRENT_REQUESTS", "8") or "8")
+# SDKが自前でhttpxクライアントを作る場合の既定と同じタイムアウト
+COHERE_REQUEST_TIMEOUT_SECONDS = 300.0
+# 同じテキスト（ファイル名・検索クエリ）の埋め込みを再利用するためのメモリキャッシュの件数上限。0で無効
+COHERE_TEXT_CACHE_SIZE = int(os.getenv("COHERE_TEXT_CACHE_SIZE", "10000") or "0")
+# Cohere互換のエンドポイント（vLLMなどでセルフホストした埋め込みモデル）を使う場合の接続先とAPIバージョン。
+# vLLMはv2の /v2/embed のみを提供するため、その場合は COHERE_API_VERSION=v2 を指定する
+COHERE_BASE_URL = os.getenv("COHERE_BASE_URL", "").strip()
+COHERE_API_VERSION = (os.getenv("COHERE_API_VERSION", "v1") or "v1").strip().lower()
+# レート制限（429）やサーバーエラー時の再試行回数と待ち時間。SDKは既定では再試行しないため、ここで指数バックオフする
+COHERE_MAX_RETRIES = int(os.getenv("COHERE_MAX_RETRIES", "4") or "0")
+COHERE_RETRY_BASE_DELAY_SECONDS = 1.0
+COHERE_RETRY_MAX_DELAY_SECONDS = 30.0
+_RETRYABLE_STATUS_CODES = frozenset({408, 409, 429})
+# trueにすると、カメラの連番（IMG_0001など）や日時・UUIDだけのファイル名は内容の手がかりにならないため、
+# テキスト側の埋め込みを取得せず画像のベクトルをそのまま使う。既定（false）はすべてのファイル名を画像と合成する。
+# 保存されるベクトルの意味が変わるため、有効にした場合はモデル識別子（キャッシュキー）にも含めて区別する
+COHERE_SKIP_UNINFORMATIVE_FILENAMES = os.getenv("COHERE_SKIP_UNINFORMATIVE_FILENAMES", "false").lower() == "true"
+# embed-v4.0の出力次元（Matryoshka表現のため先頭から切り詰めても検索に使える）。0はモデルの既定（1536次元）。
+# 512にすると保存サイズと検索時の計算量が1/3になる。変更した場合は既存のv4のベクトルと次元が合わないため再ベクトル化が必要
+COHERE_V4_OUTPUT_DIMENSION = int(os.getenv("COHERE_V4_OUTPUT_DIMENSION", "0") or "0")
+_COHERE_V4_DIMENSIONS = frozenset({256, 512, 1024, 1536})
+
+
+class PartialEmbeddingError(RuntimeError):
+    """
+    まとめての埋め込み生成で一部の要素だけが失敗したことを表す例外。
+    resultsには入力順のベクトルが入り、失敗した要素はNoneになる。
+    """
+
+    def __init__(self, results: List[Optional[np.ndarray]], cause: Exception) -> None:
+        self.results = results
+        self.failed_count = sum(1 for vector in results if vector is None)
+        super().__init__(f"{self.failed_count} of {len(results)} embeddings failed: {cause}")
+
+
 class EmbeddingProvider(ABC):
     """埋め込み生成プロバイダの共通インターフェース。"""
 
@@ -46,6 +113,42 @@ class EmbeddingProvider(ABC):
     ) -> np.ndarray:
         """テキストのみを対象にベクトルを生成する。"""
 
+    def model_identifier(self, use_embed_v4: bool = False) -> str:
+        """キャッシュキーなどに使う、プロバイダとモデルを区別する識別子を返す。"""
+        return self.provider_name
+
+    def prefetch_document_texts(self, texts: List[str], use_embed_v4: bool = False) -> Dict[str, np.ndarray]:
+        """
+        後続のembed_multimodal(_batch)で使うテキスト（ファイル名）の埋め込みを先にまとめて取得しておく。
+        取得したテキストとベクトルの辞書を返す。テキストの埋め込みを個別にキャッシュしないプロバイダでは何もせず空の辞書を返す。
+        """
+        return {}
+
+    def seed_document_texts(self, vectors: Mapping[str, np.ndarray], use_embed_v4: bool = False) -> None:
+        """
+        以前の実行で得たテキスト（ファイル名）の埋め込みを登録し、APIを呼ばずに再利用できるようにする。
+        テキストの埋め込みを個別にキャッシュしないプロバイダでは何もしない。
+        """
+
+    def embed_multimodal_batch(
+        self,
+        *,
+        texts: List[str],
+        images: List[bytes],
+        use_embed_v4: bool = False,
+    ) -> np.ndarray:
+        """
+        複数のテキストと画像の組をまとめてベクトル化し、(N, D) の行列を返す。
+        既定の実装は1件ずつembed_multimodalを呼ぶため、まとめて送れるプロバイダはオーバーライドする。
+        """
+        if len(texts) != len(images):
+            raise ValueError("texts and images must have the same length")
+        vectors = [
+            self.embed_multimodal(text=text, image_bytes=image_bytes, use_embed_v4=use_embed_v4)
+            for text, image_bytes in zip(texts, images)
+        ]
+        return np.stack(vectors).astype(np.float32, copy=False)
+
 
 class VertexEmbeddingProvider(EmbeddingProvider):
     """Vertex AIのマルチモーダル埋め込みを利用するプロバイダ。"""
@@ -70,6 +173,9 @@ class VertexEmbeddingProvider(EmbeddingProvider):
         param_list = ", ".join(self._embedding_params.keys())
         print(f"    🧾 Vertex get_embeddings parameters: {param_list}")
 
+    def model_identifier(self, use_embed_v4: bool = False) -> str:
+        return f"{self.provider_name}:{self.model_name}"
+
     def _call_get_embeddings(self, *, image=None, text: Optional[str] = None):
         kwargs = {}
         if image is not None:
@@ -158,7 +264,49 @@ class VertexEmbeddingProvider(EmbeddingProvider):
         if not image_bytes:
             return self.embed_text(text=text, use_embed_v4=use_embed_v4)
 
-        suffix = _infer_file_suffix(text)
+        print(f"    🔧 {self.display_name}: Generating multimodal embedding with model '{self.model_name}'")
+        image_vec, text_vec = self._embed_image_and_text(text, image_bytes)
+
+        final_matrix, weights = _fuse_embeddings(image_vec[None, :], text_vec[None, :])
+        print(f"    📊 Text-Image similarity: {float(weights[0]):.3f} (Vertex AI)")
+
+        self._dimension = final_matrix.shape[1]
+        return final_matrix[0]
+
+    def embed_multimodal_batch(
+        self,
+        *,
+        texts: List[str],
+        images: List[bytes],
+        use_embed_v4: bool = False,
+    ) -> np.ndarray:
+        if len(texts) != len(images):
+            raise ValueError("texts and images must have the same length")
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        if not all(images):
+            return super().embed_multimodal_batch(texts=texts, images=images, use_embed_v4=use_embed_v4)
+        if use_embed_v4:
+            print("⚠️  USE_EMBED_V4 is ignored by the Vertex AI provider.")
+
+        # Vertex AIは1リクエスト1画像のため呼び出しは1件ずつだが、重み付けと合成は行列でまとめて行う
+        print(f"    🔧 {self.display_name}: Generating {len(texts)} multimodal embeddings with model '{self.model_name}'")
+        pairs = [self._embed_image_and_text(text, image_bytes) for text, image_bytes in zip(texts, images)]
+        image_matrix = np.stack([image_vec for image_vec, _ in pairs])
+        text_matrix = np.stack([text_vec for _, text_vec in pairs])
+
+        final_matrix, weights = _fuse_embeddings(image_matrix, text_matrix)
+        print(
+            f"    📊 Text-Image similarity: mean {float(weights.mean()):.3f} "
+            f"(min {float(weights.min()):.3f}, max {float(weights.max()):.3f}) (Vertex AI)"
+        )
+
+        self._dimension = final_matrix.shape[1]
+        return final_matrix
+
+    def _embed_image_and_text(self, text: str, image_bytes: bytes) -> Tuple[np.ndarray, np.ndarray]:
+        """1組の画像とテキストから、合成前の (画像ベクトル, テキストベクトル) を取得する。"""
+        suffix = _infer_file_suffix(text, image_bytes)
         with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp_file:
             tmp_file.write(image_bytes)
             tmp_file.flush()
@@ -172,7 +320,6 @@ class VertexEmbeddingProvider(EmbeddingProvider):
             except FileNotFoundError:
                 pass
 
-        print(f"    🔧 {self.display_name}: Generating multimodal embedding with model '{self.model_name}'")
         embeddings = self._call_get_embeddings(image=vertex_image, text=text)
 
         image_embedding = getattr(embeddings, "image_embedding", None)
@@ -185,22 +332,7 @@ class VertexEmbeddingProvider(EmbeddingProvider):
             text_vec = np.asarray(text_embedding, dtype=np.float32)
         else:
             text_vec = image_vec.copy()
-
-        image_vec, text_vec = _align_dimensions(image_vec, text_vec)
-        dot_product = float(np.dot(text_vec, image_vec))
-        norm_text = float(np.linalg.norm(text_vec))
-        norm_image = float(np.linalg.norm(image_vec))
-
-        if norm_text == 0 or norm_image == 0:
-            weight = 0.5
-        else:
-            weight = max(0.0, min(1.0, dot_product / (norm_text * norm_image)))
-
-        final_vec = weight * text_vec + (1.0 - weight) * image_vec
-        print(f"    📊 Text-Image similarity: {weight:.3f} (Vertex AI)")
-
-        self._dimension = len(final_vec)
-        return final_vec.astype(np.float32)
+        return image_vec, text_vec
 
 
 class CohereEmbeddingProvider(EmbeddingProvider):
@@ -216,13 +348,175 @@ class CohereEmbeddingProvider(EmbeddingProvider):
         if not self.api_key:
             raise RuntimeError("COHERE_API_KEY must be set when using the Cohere embedding provider")
 
-        self._client = cohere.Client(self.api_key)
+        # base_urlは指定時のみ渡し、未指定ならSDKの既定（環境変数CO_API_URLまたはCohere本番）に任せる
+        client_kwargs = {"base_url": COHERE_BASE_URL} if COHERE_BASE_URL else {}
+        if httpx is not None:
+            # httpxの既定では接続が100本・再利用する接続が20本までのため、同時リクエスト数を増やすと
+            # 接続の空き待ちや張り直しが起きる。並列度に合わせて上限を広げ、TLSハンドシェイクを繰り返さないようにする
+            client_kwargs["httpx_client"] = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=max(100, COHERE_MAX_CONCURRENT_REQUESTS),
+                    max_keepalive_connections=max(20, COHERE_MAX_CONCURRENT_REQUESTS),
+                ),
+                timeout=COHERE_REQUEST_TIMEOUT_SECONDS,
+                follow_redirects=True,
+            )
+        if COHERE_API_VERSION == "v2":
+            self._client = cohere.ClientV2(self.api_key, **client_kwargs)
+        elif COHERE_API_VERSION == "v1":
+            self._client = cohere.Client(self.api_key, **client_kwargs)
+        else:
+            raise RuntimeError(f"COHERE_API_VERSION must be v1 or v2, got '{COHERE_API_VERSION}'")
+        self.api_version = COHERE_API_VERSION
+        # テキストと画像の埋め込みリクエストを並行して送るためのスレッドプール
+        self._executor = ThreadPoolExecutor(
+            max_workers=COHERE_MAX_CONCURRENT_REQUESTS,
+            thread_name_prefix="cohere-embed",
+        )
         self.default_model = os.getenv("COHERE_EMBED_MODEL_DOCUMENT", "embed-multilingual-v3.0")
         self.v4_model = os.getenv("COHERE_EMBED_MODEL_V4", "embed-v4.0")
+        if COHERE_V4_OUTPUT_DIMENSION and COHERE_V4_OUTPUT_DIMENSION not in _COHERE_V4_DIMENSIONS:
+            raise RuntimeError(
+                f"COHERE_V4_OUTPUT_DIMENSION must be one of {sorted(_COHERE_V4_DIMENSIONS)}, got {COHERE_V4_OUTPUT_DIMENSION}"
+            )
+        # (モデル, input_type, テキスト) -> ベクトル のLRUキャッシュ。埋め込み用の複数スレッドから参照される
+        self._text_cache: "OrderedDict[Tuple[str, str, str], np.ndarray]" = OrderedDict()
+        self._text_cache_lock = threading.Lock()
 
     def _resolve_model(self, use_embed_v4: bool) -> str:
         return self.v4_model if use_embed_v4 else self.default_model
 
+    def model_identifier(self, use_embed_v4: bool = False) -> str:
+        model = self._resolve_model(use_embed_v4)
+        dimension = self._output_dimension(model)
+        identifier = f"{self.provider_name}:{model}:{dimension}" if dimension else f"{self.provider_name}:{model}"
+        if COHERE_SKIP_UNINFORMATIVE_FILENAMES:
+            identifier += ":skip-uninformative-filenames"
+        return identifier
+
+    def _output_dimension(self, model: str) -> Optional[int]:
+        """モデルに指定する出力次元を返す。指定しない場合はNone。"""
+        if COHERE_V4_OUTPUT_DIMENSION and model == self.v4_model:
+            return COHERE_V4_OUTPUT_DIMENSION
+        return None
+
+    def prefetch_document_texts(self, texts: List[str], use_embed_v4: bool = False) -> Dict[str, np.ndarray]:
+        if COHERE_TEXT_CACHE_SIZE <= 0 or not texts:
+            return {}
+        unique_texts = [text for text in dict.fromkeys(texts) if self._uses_filename(text)][:COHERE_TEXT_CACHE_SIZE]
+        if not unique_texts:
+            return {}
+        model = self._resolve_model(use_embed_v4)
+        print(f"    🔧 {self.display_name}: Prefetching {len(unique_texts)} filename embeddings with model '{model}'")
+        matrix = self._submit_texts(unique_texts, model, "search_document")()
+        return dict(zip(unique_texts, matrix))
+
+    def seed_document_texts(self, vectors: Mapping[str, np.ndarray], use_embed_v4: bool = False) -> None:
+        if COHERE_TEXT_CACHE_SIZE <= 0 or not vectors:
+            return
+        model = self._resolve_model(use_embed_v4)
+        with self._text_cache_lock:
+            for text, vector in vectors.items():
+                key = (model, "search_document", text)
+                self._text_cache[key] = np.asarray(vector, dtype=np.float32)
+                self._text_cache.move_to_end(key)
+            while len(self._text_cache) > COHERE_TEXT_CACHE_SIZE:
+                self._text_cache.popitem(last=False)
+
+    @staticmethod
+    def _uses_filename(filename: str) -> bool:
+        """ファイル名の埋め込みを取得して画像と合成するかどうか。"""
+        return not COHERE_SKIP_UNINFORMATIVE_FILENAMES or _filename_has_signal(filename)
+
+    def _embed(
+        self,
+        model: str,
+        input_type: str,
+        *,
+        texts: Optional[List[str]] = None,
+        images: Optional[List[str]] = None,
+    ) -> List[List[float]]:
+        """
+        埋め込みAPIを呼び、入力順のベクトル一覧を返す。v2では埋め込みの型にfloatを指定して取り出す。
+        出力次元を指定する場合、v2ではAPIに渡し、output_dimensionを受け付けないv1では先頭から切り詰める。
+        429や5xxで失敗した場合は、並行するリクエストが同時に再送しないようジッター付きの指数バックオフで再試行する。
+        """
+        inputs = {"texts": texts} if texts is not None else {"images": images}
+        dimension = self._output_dimension(model)
+        if dimension and self.api_version == "v2":
+            inputs["output_dimension"] = dimension
+        for attempt in range(COHERE_MAX_RETRIES + 1):
+            try:
+                if self.api_version == "v2":
+                    response = self._client.embed(
+                        model=model, input_type=input_type, embedding_types=["float"], **inputs
+                    )
+                    return response.embeddings.float_
+                embeddings = self._client.embed(model=model, input_type=input_type, **inputs).embeddings
+                if dimension:
+                    return [embedding[:dimension] for embedding in embeddings]
+                return embeddings
+            except Exception as e:
+                status_code = getattr(e, "status_code", None)
+                retryable = status_code in _RETRYABLE_STATUS_CODES or (status_code is not None and status_code >= 500)
+                if not retryable or attempt >= COHERE_MAX_RETRIES:
+                    raise
+                delay = min(COHERE_RETRY_MAX_DELAY_SECONDS, COHERE_RETRY_BASE_DELAY_SECONDS * 2 ** attempt)
+                delay *= random.uniform(0.5, 1.0)
+                print(
+                    f"    ⏳ {self.display_name}: HTTP {status_code}, retrying in {delay:.1f}s "
+                    f"({attempt + 1}/{COHERE_MAX_RETRIES})"
+                )
+                time.sleep(delay)
+
+    def _embed_images(self, filenames: List[str], images: List[bytes], model: str) -> List[List[float]]:
+        """
+        画像をdata URIに変換して埋め込みAPIを呼ぶ。executor上で実行する。
+        data URIは元画像の約1.33倍の文字列になるため、バッチ全体分を先に作らず送信するチャンクの分だけ作る。
+        """
+        data_uris = [_to_data_uri(filename, image_bytes) for filename, image_bytes in zip(filenames, images)]
+        return self._embed(model, "image", images=data_uris)
+
+    def _submit_texts(self, texts: List[str], model: str, input_type: str) -> Callable[[], np.ndarray]:
+        """
+        テキストの埋め込みリクエストを送信し、結果の (N, D) 行列を返す関数を返す。
+        キャッシュ済みのテキストと同じバッチ内で重複するテキストは送信しない。
+        画像のリクエストと並行させられるよう、送信と結果の受け取りを分けている。
+        """
+        keys = [(model, input_type, text) for text in texts]
+        vectors: Dict[Tuple[str, str, str], np.ndarray] = {}
+        if COHERE_TEXT_CACHE_SIZE > 0:
+            with self._text_cache_lock:
+                for key in keys:
+                    if key in self._text_cache:
+                        self._text_cache.move_to_end(key)
+                        vectors[key] = self._text_cache[key]
+
+        missing = list(dict.fromkeys(text for key, text in zip(keys, texts) if key not in vectors))
+        futures = [
+            (
+                chunk,
+                self._executor.submit(self._embed, model, input_type, texts=chunk),
+            )
+            for chunk in _chunked(missing, COHERE_MAX_TEXTS_PER_REQUEST)
+        ]
+
+        def resolve() -> np.ndarray:
+            for chunk, future in futures:
+                embeddings = future.result()
+                for text, embedding in zip(chunk, embeddings):
+                    vectors[(model, input_type, text)] = np.asarray(embedding, dtype=np.float32)
+            if COHERE_TEXT_CACHE_SIZE > 0 and missing:
+                with self._text_cache_lock:
+                    for text in missing:
+                        key = (model, input_type, text)
+                        self._text_cache[key] = vectors[key]
+                    while len(self._text_cache) > COHERE_TEXT_CACHE_SIZE:
+                        self._text_cache.popitem(last=False)
+            return np.stack([vectors[key] for key in keys])
+
+        return resolve
+
     def embed_text(
         self,
         *,
@@ -232,13 +526,7 @@ class CohereEmbeddingProvider(EmbeddingProvider):
         model = self._resolve_model(use_embed_v4)
 
         print(f"    🔧 {self.display_name}: Generating text embedding with model '{model}'")
-        response = self._client.embed(
-            texts=[text],
-            model=model,
-            input_type="search_query",
-        )
-        vec = np.asarray(response.embeddings[0], dtype=np.float32)
-        return vec
+        return self._submit_texts([text], model, "search_query")()[0]
 
     def embed_multimodal(
         self,
@@ -254,38 +542,217 @@ class CohereEmbeddingProvider(EmbeddingProvider):
 
         print(f"    🔧 {self.display_name}: Generating multimodal embedding with model '{model}'")
 
-        text_response = self._client.embed(
-            texts=[text],
-            model=model,
-            input_type="search_document",
-        )
-        text_vec = np.asarray(text_response.embeddings[0], dtype=np.float32)
+        if not self._uses_filename(text):
+            return np.asarray(self._embed_images([text], [image_bytes], model)[0], dtype=np.float32)
 
-        mime_type = _infer_mime_type(text)
-        base64_string = base64.b64encode(image_bytes).decode("utf-8")
-        data_uri = f"data:image/{mime_type};base64,{base64_string}"
+        # input_typeが異なるため1リクエストにはまとめられないが、2つの往復を並行させて待ち時間を重ねる
+        resolve_text = self._submit_texts([text], model, "search_document")
+        image_future = self._executor.submit(self._embed_images, [text], [image_bytes], model)
+        text_vec = resolve_text()[0]
+        image_vec = np.asarray(image_future.result()[0], dtype=np.float32)
 
-        image_response = self._client.embed(
-            images=[data_uri],
-            model=model,
-            input_type="image",
-        )
-        image_vec = np.asarray(image_response.embeddings[0], dtype=np.float32)
+        final_matrix, weights = _fuse_embeddings(image_vec[None, :], text_vec[None, :])
+        print(f"    📊 Text-Image similarity: {float(weights[0]):.3f} (Cohere)")
+
+        return final_matrix[0]
 
-        image_vec, text_vec = _align_dimensions(image_vec, text_vec)
-        dot_product = float(np.dot(text_vec, image_vec))
-        norm_text = float(np.linalg.norm(text_vec))
-        norm_image = float(np.linalg.norm(image_vec))
+    def embed_multimodal_batch(
+        self,
+        *,
+        texts: List[str],
+        images: List[bytes],
+        use_embed_v4: bool = False,
+    ) -> np.ndarray:
+        if len(texts) != len(images):
+            raise ValueError("texts and images must have the same length")
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        if not all(images):
+            return super().embed_multimodal_batch(texts=texts, images=images, use_embed_v4=use_embed_v4)
 
-        if norm_text == 0 or norm_image == 0:
-            weight = 0.5
+        model = self._resolve_model(use_embed_v4)
+        print(f"    🔧 {self.display_name}: Generating {len(texts)} multimodal embeddings with model '{model}'")
+
+        # ファイル名はまとめて1リクエストにし、画像は1リクエストあたりの上限ごとに分けて並行送信する。
+        # 内容の手がかりにならないファイル名はテキスト側を取得せず、画像のベクトルをそのまま使う
+        text_positions = {index: position for position, index in enumerate(
+            index for index, text in enumerate(texts) if self._uses_filename(text)
+        )}
+        resolve_texts = self._submit_texts([texts[index] for index in text_positions], model, "search_document")
+        image_futures = [
+            (len(name_chunk), self._executor.submit(self._embed_images, name_chunk, image_chunk, model))
+            for name_chunk, image_chunk in zip(
+                _chunked(texts, COHERE_MAX_IMAGES_PER_REQUEST),
+                _chunked(images, COHERE_MAX_IMAGES_PER_REQUEST),
+            )
+        ]
+        text_matrix = resolve_texts() if text_positions else None
+
+        # 画像は別々のリクエストで送っているため、失敗したリクエストの分だけを欠損として扱い、残りは結果として使う
+        image_rows: List[Optional[List[float]]] = []
+        image_error: Optional[Exception] = None
+        for size, future in image_futures:
+            try:
+                image_rows.extend(future.result())
+            except Exception as e:
+                image_rows.extend([None] * size)
+                image_error = e
+        succeeded = [index for index, row in enumerate(image_rows) if row is not None]
+        if not succeeded:
+            raise image_error
+
+        image_matrix = np.asarray([image_rows[index] for index in succeeded], dtype=np.float32)
+        fused_rows = [row for row, index in enumerate(succeeded) if index in text_positions]
+        if len(fused_rows) == len(succeeded):
+            final_matrix, weights = _fuse_embeddings(image_matrix, text_matrix[[text_positions[i] for i in succeeded]])
         else:
-            weight = max(0.0, min(1.0, dot_product / (norm_text * norm_image)))
+            final_matrix = image_matrix
+            weights = None
+            if fused_rows:
+                fused, weights = _fuse_embeddings(
+                    image_matrix[fused_rows],
+                    text_matrix[[text_positions[succeeded[row]] for row in fused_rows]],
+                )
+                final_matrix[fused_rows] = fused
+            print(f"    🏷️  {len(succeeded) - len(fused_rows)} filenames carry no content hint; using image embeddings only")
+        if weights is not None:
+            print(
+                f"    📊 Text-Image similarity: mean {float(weights.mean()):.3f} "
+                f"(min {float(weights.min()):.3f}, max {float(weights.max()):.3f}) (Cohere)"
+            )
+        if image_error is None:
+            return final_matrix
+        results: List[Optional[np.ndarray]] = [None] * len(texts)
+        for row, index in enumerate(succeeded):
+            results[index] = final_matrix[row]
+        raise PartialEmbeddingError(results, image_error)
+
+
+# draftで縮小デコードできる形式（カメラの写真に多いMPOはJPEGの派生形式）
+_DRAFT_FORMATS = frozenset({"JPEG", "MPO"})
+
+
+class OpenClipEmbeddingProvider(EmbeddingProvider):
+    """
+    open_clipのCLIP系モデルをローカルで実行するプロバイダ。GPUがあればfloat16で推論する。
+    画像・ファイル名・検索クエリをすべて同じモデルでベクトル化するため、インデックス作成と検索の両方で
+    このプロバイダを選ぶ必要がある（Cohere/Vertex AIのベクトルとは互換性がない）。
+    """
+
+    def __init__(self) -> None:
+        if torch is None or open_clip is None or PILImage is None:
+            raise ImportError("torch and open_clip_torch packages are required for OpenClipEmbeddingProvider")
+
+        self.provider_name = "open_clip"
+        self.display_name = "OpenCLIP"
+        self.model_name = os.getenv("OPEN_CLIP_MODEL", "ViT-L-14")
+        self.pretrained = os.getenv("OPEN_CLIP_PRETRAINED", "openai")
+        self.batch_size = int(os.getenv("OPEN_CLIP_BATCH_SIZE", "32") or "32")
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+
+        model, _, preprocess = open_clip.create_model_and_transforms(
+            self.model_name,
+            pretrained=self.pretrained,
+            device=self.device,
+        )
+        model.eval()
+        self._model = model
+        self._preprocess = preprocess
+        self._tokenizer = open_clip.get_tokenizer(self.model_name)
+        image_size = getattr(model.visual, "image_size", 224)
+        if isinstance(image_size, (tuple, list)):
+            image_size = max(image_size)
+        self._image_size = int(image_size)
+        # 推論は埋め込み用の複数スレッドから呼ばれるため、モデルへのアクセスは直列化する
+        self._lock = threading.Lock()
+        print(f"    🖥️  OpenCLIP model '{self.model_name}' ({self.pretrained}) loaded on {self.device}")
+
+    def model_identifier(self, use_embed_v4: bool = False) -> str:
+        return f"{self.provider_name}:{self.model_name}:{self.pretrained}"
+
+    def _autocast(self):
+        if self.device == "cuda":
+            return torch.autocast(device_type="cuda", dtype=torch.float16)
+        return contextlib.nullcontext()
+
+    def _encode_texts(self, texts: List[str]) -> np.ndarray:
+        tokens = self._tokenizer(texts).to(self.device)
+        with self._lock, torch.inference_mode(), self._autocast():
+            features = self._model.encode_text(tokens)
+        return features.float().cpu().numpy()
+
+    def _load_image(self, image_bytes: bytes):
+        """
+        前処理用に画像を開く。モデルの入力は数百ピクセル四方しかないため、JPEGはdraftでDCT領域の縮小を指定し、
+        フル解像度への展開を避ける（短辺が入力サイズを下回らない範囲でしか縮小されない）。
+        """
+        img = PILImage.open(io.BytesIO(image_bytes))
+        if img.format in _DRAFT_FORMATS:
+            img.draft("RGB", (self._image_size, self._image_size))
+        return img.convert("RGB")
+
+    def _encode_images(self, images: List[bytes]) -> np.ndarray:
+        pixels = torch.stack([
+            self._preprocess(self._load_image(image_bytes))
+            for image_bytes in images
+        ]).to(self.device)
+        with self._lock, torch.inference_mode(), self._autocast():
+            features = self._model.encode_image(pixels)
+        return features.float().cpu().numpy()
+
+    def embed_text(
+        self,
+        *,
+        text: str,
+        use_embed_v4: bool = False,
+    ) -> np.ndarray:
+        if use_embed_v4:
+            print("⚠️  USE_EMBED_V4 is ignored by the OpenCLIP provider.")
+        print(f"    🔧 {self.display_name}: Generating text embedding with model '{self.model_name}'")
+        return self._encode_texts([text])[0]
 
-        final_vec = weight * text_vec + (1.0 - weight) * image_vec
-        print(f"    📊 Text-Image similarity: {weight:.3f} (Cohere)")
+    def embed_multimodal(
+        self,
+        *,
+        text: str,
+        image_bytes: Optional[bytes],
+        use_embed_v4: bool = False,
+    ) -> np.ndarray:
+        if not image_bytes:
+            return self.embed_text(text=text, use_embed_v4=use_embed_v4)
+        return self.embed_multimodal_batch(texts=[text], images=[image_bytes], use_embed_v4=use_embed_v4)[0]
 
-        return final_vec.astype(np.float32)
+    def embed_multimodal_batch(
+        self,
+        *,
+        texts: List[str],
+        images: List[bytes],
+        use_embed_v4: bool = False,
+    ) -> np.ndarray:
+        if len(texts) != len(images):
+            raise ValueError("texts and images must have the same length")
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        if not all(images):
+            return super().embed_multimodal_batch(texts=texts, images=images, use_embed_v4=use_embed_v4)
+        if use_embed_v4:
+            print("⚠️  USE_EMBED_V4 is ignored by the OpenCLIP provider.")
+
+        print(f"    🔧 {self.display_name}: Generating {len(texts)} multimodal embeddings with model '{self.model_name}'")
+        # GPUを使い切れるよう、画像とテキストはそれぞれOPEN_CLIP_BATCH_SIZE件ずつまとめて推論する
+        image_matrix = np.concatenate([
+            self._encode_images(chunk) for chunk in _chunked(images, self.batch_size)
+        ])
+        text_matrix = np.concatenate([
+            self._encode_texts(chunk) for chunk in _chunked(texts, self.batch_size)
+        ])
+
+        final_matrix, weights = _fuse_embeddings(image_matrix, text_matrix)
+        print(
+            f"    📊 Text-Image similarity: mean {float(weights.mean()):.3f} "
+            f"(min {float(weights.min()):.3f}, max {float(weights.max()):.3f}) (OpenCLIP)"
+        )
+        return final_matrix
 
 
 _PROVIDER_CACHE: Dict[str, EmbeddingProvider] = {}
@@ -310,6 +777,8 @@ def get_embedding_provider(
         provider = VertexEmbeddingProvider()
     elif resolved_provider == "cohere":
         provider = CohereEmbeddingProvider()
+    elif resolved_provider == "open_clip":
+        provider = OpenClipEmbeddingProvider()
     else:
         raise ValueError(f"Unsupported EMBEDDING_PROVIDER: {resolved_provider}")
 
@@ -318,36 +787,116 @@ def get_embedding_provider(
     return provider
 
 
-def _infer_file_suffix(filename: str) -> str:
-    ext = filename.lower().split(".")[-1]
-    if ext in {"jpg", "jpeg"}:
-        return ".jpg"
-    if ext == "png":
-        return ".png"
-    if ext == "gif":
-        return ".gif"
-    if ext == "webp":
-        return ".webp"
-    return ".jpg"
-
-
-def _infer_mime_type(filename: str) -> str:
-    ext = filename.lower().split(".")[-1]
-    if ext in {"jpg", "jpeg"}:
+_FILE_SUFFIX_BY_EXT: Mapping[str, str] = MappingProxyType({
+    "jpg": ".jpg",
+    "jpeg": ".jpg",
+    "png": ".png",
+    "gif": ".gif",
+    "webp": ".webp",
+})
+
+_MIME_TYPE_BY_EXT: Mapping[str, str] = MappingProxyType({
+    "jpg": "jpeg",
+    "jpeg": "jpeg",
+    "png": "png",
+    "gif": "gif",
+    "webp": "webp",
+})
+
+
+def _file_extension(filename: str) -> str:
+    """拡張子を先頭のドットなし・小文字で返す。ファイル名全体を小文字化・分割しないよう拡張子部分だけを扱う。"""
+    return os.path.splitext(filename)[1][1:].lower()
+
+
+# 拡張子を除いたファイル名がこれらに一致する場合は、内容を表す語を含まないものとみなす
+_UNINFORMATIVE_FILENAME_PATTERNS = (
+    # カメラ・スマートフォン・スクリーンショットの自動命名（接頭辞＋数字・日時・連番）
+    re.compile(r"(?:img|dsc[nf]?|pxl|mvimg|scr|image|photo|screenshot|スクリーンショット)?[\d\s_.()\-]*", re.IGNORECASE),
+    # UUIDや16進のハッシュ値
+    re.compile(r"[0-9a-f\-]{16,}", re.IGNORECASE),
+)
+
+
+def _filename_has_signal(filename: str) -> bool:
+    """ファイル名（拡張子を除く）が画像の内容を表す語を含みうるかを返す。自動命名や識別子だけの場合はFalse。"""
+    stem = os.path.splitext(filename)[0].strip()
+    return not any(pattern.fullmatch(stem) for pattern in _UNINFORMATIVE_FILENAME_PATTERNS)
+
+
+def _sniff_image_type(image_bytes: Optional[bytes]) -> Optional[str]:
+    """
+    先頭のマジックバイトから画像形式（_MIME_TYPE_BY_EXTの値と同じ表記）を判定する。判定できない場合はNone。
+    Driveでは拡張子と中身が一致しないファイル（縮小時のJPEG再エンコードを含む）があるため、拡張子より優先する。
+    """
+    if not image_bytes:
+        return None
+    header = bytes(image_bytes[:12])
+    if header.startswith(b"\xff\xd8\xff"):
         return "jpeg"
-    if ext == "png":
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
         return "png"
-    if ext == "gif":
-        return "gif"
-    if ext == "webp":
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
         return "webp"
-    return "jpeg"
-
-
-def _align_dimensions(image_vec: np.ndarray, text_vec: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
-    """画像とテキストのベクトル次元を揃える。"""
-    if image_vec.shape == text_vec.shape:
-        return image_vec, text_vec
+    if header.startswith((b"GIF87a", b"GIF89a")):
+        return "gif"
+    return None
+
+
+def _infer_file_suffix(filename: str, image_bytes: Optional[bytes] = None) -> str:
+    sniffed = _sniff_image_type(image_bytes)
+    if sniffed is not None:
+        return _FILE_SUFFIX_BY_EXT[sniffed]
+    return _FILE_SUFFIX_BY_EXT.get(_file_extension(filename), ".jpg")
+
+
+def _infer_mime_type(filename: str, image_bytes: Optional[bytes] = None) -> str:
+    sniffed = _sniff_image_type(image_bytes)
+    if sniffed is not None:
+        return sniffed
+    return _MIME_TYPE_BY_EXT.get(_file_extension(filename), "jpeg")
+
+
+def _to_data_uri(filename: str, image_bytes: bytes) -> str:
+    """
+    画像データをCohereに送るdata URIに変換する。pybase64があればSIMD実装でエンコードし、
+    bytesを経由せず直接strとして受け取ることで、base64のbytesをstrへデコードする際のコピーを省く。
+    """
+    prefix = f"data:image/{_infer_mime_type(filename, image_bytes)};base64,"
+    if pybase64 is not None:
+        return prefix + pybase64.b64encode_as_string(image_bytes)
+    return prefix + base64.b64encode(image_bytes).decode("ascii")
+
+
+def _chunked(items: List, size: int) -> Iterator[List]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _fuse_embeddings(image_matrix: np.ndarray, text_matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (N, D) の画像・テキスト行列から、行ごとのコサイン類似度を重みとした合成ベクトルをまとめて計算する。
+    重みは0〜1に丸め、どちらかのノルムが0の行は0.5とする。
+
+    戻り値:
+        合成ベクトルの行列 (N, D) と重み (N,) のタプル
+    """
+    dim = min(image_matrix.shape[1], text_matrix.shape[1])
+    image_matrix = np.asarray(image_matrix[:, :dim], dtype=np.float32)
+    text_matrix = np.asarray(text_matrix[:, :dim], dtype=np.float32)
+
+    # 内積とノルムはeinsumで行ごとに縮約し、(N, D) の一時配列を作らない
+    dots = np.einsum("ij,ij->i", text_matrix, image_matrix)
+    norms = np.sqrt(
+        np.einsum("ij,ij->i", text_matrix, text_matrix) * np.einsum("ij,ij->i", image_matrix, image_matrix)
+    )
+    weights = np.full(dots.shape, 0.5, dtype=np.float32)
+    np.divide(dots, norms, out=weights, where=norms != 0)
+    np.clip(weights, 0.0, 1.0, out=weights)
+
+    # w*T + (1-w)*I を I + w*(T-I) として1つの出力配列上で計算する
+    final_matrix = np.subtract(text_matrix, image_matrix)
+    final_matrix *= weights[:, None]
+    final_matrix += image_matrix
+    return final_matrix, weights
 
-    min_dim = min(image_vec.shape[0], text_vec.shape[0])
-    return image_vec[:min_dim], text_vec[:min_dim]
@@ -0,0 +1,494 @@
+"""
+企業ごとのベクトルデータをGoogle Cloud Storageに保存・読み込みするモジュール。
+
+保存形式:
+    {uuid}.json: ファイル名やパスなどのメタデータ一覧。埋め込みを持つ行には embedding_index を付与する
+    {uuid}.npy : 埋め込みベクトルをまとめた (N, D) の行列（np.save形式）
+
+埋め込みをJSONの数値配列として書き出すとサイズもパース時間も大きくなるため、行列はnpyで別に保存する。
+行列は既定でfloat16として保存し（EMBEDDING_STORAGE_DTYPEで変更可）、読み込み時にfloat32へ戻す。
+コサイン類似度による検索ではfloat16の精度で十分なため、保存サイズと転送量を半分にできる。
+EMBEDDING_STORAGE_DTYPE=int8 の場合は行ごとに最大絶対値で量子化し、int8の行列と行ごとのスケールを
+npz形式で {uuid}.npy に保存する（float32の1/4のサイズ）。読み込み時はファイルの先頭から形式を判別する。
+メタデータJSONは既定でgzip圧縮して保存する（EMBEDDING_METADATA_GZIP=falseで無効）。orjsonがあればJSONの読み書きに使う。
+
+処理途中のチェックポイントは全件を書き直さず、前回の保存以降に追加された分だけを差分として保存する。
+    {uuid}.part-{開始位置}.json / .npy: 先頭から「開始位置」件の後ろに続くレコード（形式は本体と同じ）
+読み込み時は本体と差分を並列に取得し、本体の件数から途切れずに続く差分だけを順に連結する。全件を保存する際は差分を先に削除する。
+メタデータJSONには対になる行列のチェックサムをカスタムメタデータとして付け、読み込み時に照合する。
+embedding をJSON内に直接持つ旧形式のファイルや、float32で保存された行列も引き続き読み込める。
+"""
+
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from google.api_core.exceptions import NotFound
+
+try:
+    import orjson  # type: ignore
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    from google.cloud.storage import transfer_manager  # type: ignore
+except ImportError:  # pragma: no cover
+    transfer_manager = None
+
+EMBEDDING_DTYPE = np.float32
+STORAGE_DTYPE = np.dtype(os.getenv("EMBEDDING_STORAGE_DTYPE", "float16") or "float16")
+if STORAGE_DTYPE not in (np.dtype(np.float16), np.dtype(np.float32), np.dtype(np.int8)):
+    raise RuntimeError(f"EMBEDDING_STORAGE_DTYPE must be float16, float32 or int8, got '{STORAGE_DTYPE}'")
+_FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+# これを超える行列はメモリ上にnpy全体を組み立てず、GCSのresumable uploadでチャンクごとに送る
+STREAMING_UPLOAD_THRESHOLD_BYTES = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# これ以上の行列は一時ファイルに書き出し、XMLマルチパートアップロードで複数のパートを並列に送る（0で無効）。
+# 1本のresumable uploadではチャンクを順に送るため、数十MB以上の行列ではアップロードの往復が律速になる
+PARALLEL_UPLOAD_MIN_BYTES = int(float(os.getenv("EMBEDDING_PARALLEL_UPLOAD_MIN_MB", "32") or "0") * 1024 * 1024)
+PARALLEL_UPLOAD_WORKERS = 8
+# 大きな行列を行から組み立てながら書き込む際に、一度に変換する行数
+UPLOAD_ROW_BLOCK = 4096
+# これ以上の件数のメタデータはJSON全体を1つの文字列にせず、1件ずつblob.openへ書き込む（1件あたり数百バイト程度）
+STREAMING_METADATA_MIN_ROWS = 20_000
+# メタデータJSONのカスタムメタデータに記録する、対になる行列のチェックサム（blake2b、16バイト）のキー。
+# JSONと行列は別々のアップロードのため、読み込み時に件数だけでなく内容が同じ保存のものかを確かめる
+MATRIX_CHECKSUM_KEY = "matrix-checksum"
+# 差分チェックポイントがある場合に、本体と差分を並列に取得するスレッド数
+LOAD_WORKERS = 8
+# 複数のオブジェクトを削除する際に、1回のバッチリクエストにまとめる件数（GCSのバッチリクエストの上限は100件）
+DELETE_BATCH_SIZE = 100
+# メタデータJSONをgzip圧縮し、Content-Encoding: gzipとして保存する。ファイル名・URL・ハッシュの繰り返しが多く数分の1になる。
+# GCSはgzipを受け付けないクライアントには展開して返す（解凍トランスコーディング）ため、読み手側の変更は不要
+METADATA_GZIP = os.getenv("EMBEDDING_METADATA_GZIP", "true").lower() == "true"
+METADATA_GZIP_LEVEL = 6
+
+
+def metadata_blob_name(uuid: str) -> str:
+    """メタデータJSONのオブジェクト名を返す。"""
+    return f"{uuid}.json"
+
+
+def matrix_blob_name(uuid: str) -> str:
+    """埋め込み行列（npy）のオブジェクト名を返す。"""
+    return f"{uuid}.npy"
+
+
+def part_blob_prefix(uuid: str) -> str:
+    """差分チェックポイントのオブジェクト名の接頭辞を返す。"""
+    return f"{uuid}.part-"
+
+
+def part_name(uuid: str, start: int) -> str:
+    """先頭からstart件の後ろに続く差分チェックポイントの名前（拡張子なし）を返す。名前順が開始位置の順になるよう桁をそろえる。"""
+    return f"{part_blob_prefix(uuid)}{start:010d}"
+
+
+def _split_rows(records: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[np.ndarray]]:
+    """split_recordsと同じ分割を行い、埋め込みは行列にまとめず行ごとの配列のリストで返す。"""
+    metadata: List[Dict[str, Any]] = []
+    vectors: List[np.ndarray] = []
+    for record in records:
+        item = {key: value for key, value in record.items() if key not in ("embedding", "embedding_index")}
+        embedding = record.get("embedding")
+        if embedding is not None and len(embedding) > 0:
+            item["embedding_index"] = len(vectors)
+            vectors.append(np.asarray(embedding, dtype=EMBEDDING_DTYPE))
+        else:
+            item["embedding_index"] = None
+        metadata.append(item)
+    return metadata, vectors
+
+
+def split_records(records: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], np.ndarray]:
+    """
+    embedding を含むレコード一覧を、メタデータ一覧と埋め込み行列に分割する。
+
+    引数:
+        records: embedding（ndarrayまたは数値リスト、無効な場合はNone）を持つレコードのリスト
+
+    戻り値:
+        embedding を embedding_index に置き換えたメタデータのリストと、(N, D) の行列のタプル
+    """
+    metadata, vectors = _split_rows(records)
+    if vectors:
+        matrix = np.stack(vectors)
+    else:
+        matrix = np.empty((0, 0), dtype=EMBEDDING_DTYPE)
+    return metadata, matrix
+
+
+def _to_storage_dtype(matrix: np.ndarray) -> np.ndarray:
+    """
+    埋め込み行列をSTORAGE_DTYPEに変換する。
+    float16の範囲を超える値を含む場合は、値が壊れないようfloat32のまま保存する。
+    """
+    dtype = STORAGE_DTYPE
+    if dtype == np.float16 and matrix.size and float(np.abs(matrix).max()) > _FLOAT16_MAX:
+        dtype = np.dtype(EMBEDDING_DTYPE)
+    return matrix.astype(dtype, copy=False)
+
+
+def _quantize_int8(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """行ごとの最大絶対値が127になるようint8へ量子化し、(量子化した行列, 行ごとのスケール) を返す。"""
+    matrix = np.asarray(matrix, dtype=EMBEDDING_DTYPE)
+    if matrix.size:
+        scale = (np.abs(matrix).max(axis=1) / 127).astype(EMBEDDING_DTYPE)
+    else:
+        scale = np.zeros(len(matrix), dtype=EMBEDDING_DTYPE)
+    divisor = np.where(scale > 0, scale, 1).astype(EMBEDDING_DTYPE)
+    quantized = np.rint(matrix / divisor[:, None]).astype(np.int8)
+    return quantized, scale
+
+
+def encode_matrix(matrix: np.ndarray) -> bytes:
+    """埋め込み行列をSTORAGE_DTYPEのnpy形式（int8の場合はスケール付きのnpz形式）のバイト列に変換する。"""
+    buffer = io.BytesIO()
+    if STORAGE_DTYPE == np.int8:
+        quantized, scale = _quantize_int8(matrix)
+        np.savez(buffer, matrix=quantized, scale=scale)
+    else:
+        np.save(buffer, _to_storage_dtype(matrix), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def _matrix_checksum(data: bytes) -> str:
+    """行列のバイト列のチェックサムを返す。メタデータJSONと行列が同じ保存で書かれた組かを読み込み時に確かめるために使う。"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class _ChecksumWriter:
+    """書き込み先へ転送しながら、書き込んだバイト列のチェックサム（_matrix_checksumと同じ値）を計算する。"""
+
+    def __init__(self, stream) -> None:
+        self._stream = stream
+        self._hasher = hashlib.blake2b(digest_size=16)
+
+    def write(self, data) -> int:
+        self._hasher.update(data)
+        return self._stream.write(data)
+
+    def hexdigest(self) -> str:
+        return self._hasher.hexdigest()
+
+
+@contextlib.contextmanager
+def _open_matrix_writer(blob, nbytes: int):
+    """
+    大きな行列の書き込み先（_ChecksumWriter）を返す。通常はblob.openへ直接書き込み、PARALLEL_UPLOAD_MIN_BYTES以上の場合は
+    一時ファイルに書き出してから、transfer_managerでパートごとに並列アップロードする。
+    """
+    if transfer_manager is None or PARALLEL_UPLOAD_MIN_BYTES <= 0 or nbytes < PARALLEL_UPLOAD_MIN_BYTES:
+        with blob.open("wb", content_type="application/octet-stream", chunk_size=UPLOAD_CHUNK_SIZE, ignore_flush=True) as writer:
+            yield _ChecksumWriter(writer)
+        return
+    with tempfile.NamedTemporaryFile(suffix=".npy") as temp:
+        yield _ChecksumWriter(temp)
+        temp.flush()
+        # アップロードはネットワーク待ちが中心のため、クライアントを複製するプロセスではなくスレッドで並列化する
+        transfer_manager.upload_chunks_concurrently(
+            temp.name,
+            blob,
+            content_type="application/octet-stream",
+            chunk_size=UPLOAD_CHUNK_SIZE,
+            worker_type=transfer_manager.THREAD,
+            max_workers=PARALLEL_UPLOAD_WORKERS,
+        )
+
+
+def _upload_encoded(blob, data: bytes) -> str:
+    blob.upload_from_string(data, content_type="application/octet-stream")
+    return _matrix_checksum(data)
+
+
+def _upload_matrix(blob, matrix: np.ndarray) -> str:
+    """
+    埋め込み行列をnpy形式でアップロードし、アップロードした内容のチェックサムを返す。
+    大きな行列はBytesIOに全体を書き出すとその分だけメモリを消費するため、blob.openへ直接書き込む（_open_matrix_writerを参照）。
+    """
+    if STORAGE_DTYPE == np.int8:
+        # npzはzip形式で書き込み先のシークを伴うため、ストリーミングせずに組み立てる（float32の1/4のサイズで済む）
+        return _upload_encoded(blob, encode_matrix(matrix))
+    stored = _to_storage_dtype(matrix)
+    if stored.nbytes < STREAMING_UPLOAD_THRESHOLD_BYTES:
+        return _upload_encoded(blob, encode_matrix(stored))
+    with _open_matrix_writer(blob, stored.nbytes) as writer:
+        np.save(writer, stored, allow_pickle=False)
+    return writer.hexdigest()
+
+
+def _upload_rows(blob, vectors: List[np.ndarray]) -> str:
+    """
+    行ごとの埋め込みをnpy形式でアップロードし、アップロードした内容のチェックサムを返す。
+    大きな場合は (N, D) のfloat32行列と保存用の型の行列を丸ごと作らず、UPLOAD_ROW_BLOCK行ずつ変換して書き込む。
+    """
+    dim = len(vectors[0]) if vectors else 0
+    if (
+        STORAGE_DTYPE == np.int8
+        or len(vectors) * dim * STORAGE_DTYPE.itemsize < STREAMING_UPLOAD_THRESHOLD_BYTES
+    ):
+        matrix = np.stack(vectors) if vectors else np.empty((0, 0), dtype=EMBEDDING_DTYPE)
+        return _upload_matrix(blob, matrix)
+    if any(len(vector) != dim for vector in vectors):
+        raise ValueError("All embeddings must have the same dimension to be stored as a matrix.")
+
+    blocks = range(0, len(vectors), UPLOAD_ROW_BLOCK)
+    dtype = STORAGE_DTYPE
+    if dtype == np.float16 and any(
+        float(np.abs(np.stack(vectors[start:start + UPLOAD_ROW_BLOCK])).max()) > _FLOAT16_MAX for start in blocks
+    ):
+        dtype = np.dtype(EMBEDDING_DTYPE)
+    header = {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": (len(vectors), dim)}
+    with _open_matrix_writer(blob, len(vectors) * dim * dtype.itemsize) as writer:
+        np.lib.format.write_array_header_1_0(writer, header)
+        for start in blocks:
+            writer.write(np.stack(vectors[start:start + UPLOAD_ROW_BLOCK]).astype(dtype).tobytes())
+    return writer.hexdigest()
+
+
+def _dumps_json(value: Any) -> bytes:
+    """JSONのUTF-8バイト列を返す。orjsonがあれば、文字列を経由せず直接バイト列に書き出す高速な実装を使う。"""
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(value, ensure_ascii=False).encode("utf-8")
+
+
+def _loads_json(data: bytes) -> Any:
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def _upload_metadata(blob, metadata: List[Dict[str, Any]], matrix_checksum: Optional[str] = None) -> None:
+    """
+    メタデータ一覧をJSON配列としてアップロードする。matrix_checksumはオブジェクトのカスタムメタデータとして付ける。
+    件数が多い場合は、JSON文字列とそのUTF-8エンコード結果を丸ごとメモリに持たないよう、1件ずつ書き込む。
+    """
+    if matrix_checksum is not None:
+        blob.metadata = {MATRIX_CHECKSUM_KEY: matrix_checksum}
+    if METADATA_GZIP:
+        blob.content_encoding = "gzip"
+    if len(metadata) < STREAMING_METADATA_MIN_ROWS:
+        data = _dumps_json(metadata)
+        if METADATA_GZIP:
+            data = gzip.compress(data, compresslevel=METADATA_GZIP_LEVEL)
+        blob.upload_from_string(data, content_type="application/json")
+        return
+    with contextlib.ExitStack() as stack:
+        stream = stack.enter_context(
+            blob.open("wb", content_type="application/json", chunk_size=UPLOAD_CHUNK_SIZE, ignore_flush=True)
+        )
+        if METADATA_GZIP:
+            stream = stack.enter_context(
+                gzip.GzipFile(fileobj=stream, mode="wb", compresslevel=METADATA_GZIP_LEVEL)
+            )
+        stream.write(b"[")
+        for index, item in enumerate(metadata):
+            if index:
+                stream.write(b",")
+            stream.write(_dumps_json(item))
+        stream.write(b"]")
+
+
+def decode_matrix(data: bytes) -> np.ndarray:
+    """npy形式（またはint8量子化のnpz形式）のバイト列から埋め込み行列を復元する。保存時の型にかかわらずfloat32で返す。"""
+    loaded = np.load(io.BytesIO(data), allow_pickle=False)
+    if isinstance(loaded, np.lib.npyio.NpzFile):
+        with loaded:
+            matrix = loaded["matrix"].astype(EMBEDDING_DTYPE)
+            matrix *= loaded["scale"][:, None]
+            return matrix
+    return loaded.astype(EMBEDDING_DTYPE, copy=False)
+
+
+def _is_consistent(metadata: List[Dict[str, Any]], matrix: Optional[np.ndarray]) -> bool:
+    indexed = [item["embedding_index"] for item in metadata if item.get("embedding_index") is not None]
+    if not indexed:
+        return True
+    if matrix is None:
+        return False
+    return len(indexed) == matrix.shape[0] and max(indexed) < matrix.shape[0]
+
+
+def _load_single(bucket, name: str) -> Optional[Tuple[List[Dict[str, Any]], np.ndarray]]:
+    """
+    {name}.json と {name}.npy の組を読み込む。書き込み途中の組み合わせを避けるため、JSONに付けた行列のチェックサム
+    （チェックサムを持たない以前の保存では件数）が合わない場合は一度だけ読み直す。
+    """
+    for _ in range(2):
+        # カスタムメタデータ（チェックサム）と本文が同じ世代のものになるよう、取得した世代を指定して本文を読む
+        metadata_blob = bucket.get_blob(metadata_blob_name(name))
+        if metadata_blob is None:
+            return None
+        try:
+            raw_data = _loads_json(metadata_blob.download_as_bytes())
+        except NotFound:
+            # 取得後に上書きされ、その世代が無くなっている
+            continue
+        if not isinstance(raw_data, list):
+            raise ValueError("Vector file format is invalid. Expected a list of entries.")
+
+        if not any("embedding_index" in item for item in raw_data):
+            # 旧形式: embedding がJSON内に直接含まれている
+            return split_records(raw_data)
+
+        expected_checksum = (metadata_blob.metadata or {}).get(MATRIX_CHECKSUM_KEY)
+        matrix_blob = bucket.blob(matrix_blob_name(name))
+        matrix_data = matrix_blob.download_as_bytes() if matrix_blob.exists() else None
+        if expected_checksum is not None and (matrix_data is None or _matrix_checksum(matrix_data) != expected_checksum):
+            continue
+        matrix = decode_matrix(matrix_data) if matrix_data is not None else None
+        if _is_consistent(raw_data, matrix):
+            if matrix is None:
+                matrix = np.empty((0, 0), dtype=EMBEDDING_DTYPE)
+            return raw_data, matrix
+
+    raise ValueError(f"Vector data '{name}' is inconsistent between JSON metadata and npy matrix.")
+
+
+def _list_parts(bucket, uuid: str) -> List[Tuple[int, str]]:
+    """差分チェックポイントの (開始位置, 名前) を開始位置の順に返す。"""
+    prefix = part_blob_prefix(uuid)
+    parts = []
+    for blob in bucket.list_blobs(prefix=prefix):
+        stem, ext = os.path.splitext(blob.name)
+        if ext != ".json" or not stem[len(prefix):].isdigit():
+            continue
+        parts.append((int(stem[len(prefix):]), stem))
+    parts.sort()
+    return parts
+
+
+def count_parts(bucket, uuid: str) -> int:
+    """保存されている差分チェックポイントの数を返す。"""
+    return len(_list_parts(bucket, uuid))
+
+
+def _append_part(
+    metadata: List[Dict[str, Any]], matrix: np.ndarray, part: Tuple[List[Dict[str, Any]], np.ndarray]
+) -> Tuple[List[Dict[str, Any]], np.ndarray]:
+    """差分のメタデータと行列を後ろに連結する。差分側の embedding_index は連結後の行番号に振り直す。"""
+    part_metadata, part_matrix = part
+    offset = matrix.shape[0]
+    for item in part_metadata:
+        if item.get("embedding_index") is not None:
+            item["embedding_index"] += offset
+    if part_matrix.size:
+        matrix = np.vstack([matrix, part_matrix]) if matrix.size else part_matrix
+    return metadata + part_metadata, matrix
+
+
+def load_store(bucket, uuid: str) -> Optional[Tuple[List[Dict[str, Any]], np.ndarray]]:
+    """
+    GCSからメタデータと埋め込み行列を読み込む。差分チェックポイントがあれば続けて連結する。
+
+    旧形式（JSON内に embedding を持つ）の場合は、その場で行列に変換して同じ形で返す。
+    書き込み途中のJSONとnpyを組み合わせて読まないよう、件数が合わない場合は一度だけ読み直す。
+    差分は開始位置がそれまでの件数と一致するものだけを使い、途切れた以降（全件保存で不要になった残りなど）は無視する。
+
+    引数:
+        bucket: google.cloud.storage.Bucket
+        uuid: 企業のUUID
+
+    戻り値:
+        (メタデータのリスト, 埋め込み行列) のタプル。ファイルが存在しない場合はNone
+
+    例外:
+        ValueError: ファイル形式が不正な場合、またはJSONとnpyの整合性が取れない場合
+    """
+    parts = _list_parts(bucket, uuid)
+    if parts:
+        # 本体と差分はそれぞれ数回の往復を要するため、順に取得せず並列に取得してから開始位置の順に連結する
+        names = [uuid] + [name for _, name in parts]
+        with ThreadPoolExecutor(max_workers=min(LOAD_WORKERS, len(names))) as executor:
+            loaded, *part_results = executor.map(lambda name: _load_single(bucket, name), names)
+    else:
+        loaded, part_results = _load_single(bucket, uuid), []
+    if loaded is None and not parts:
+        return None
+    metadata, matrix = loaded if loaded is not None else ([], np.empty((0, 0), dtype=EMBEDDING_DTYPE))
+    for (start, _), part in zip(parts, part_results):
+        if start != len(metadata) or part is None:
+            break
+        metadata, matrix = _append_part(metadata, matrix, part)
+    return metadata, matrix
+
+
+def load_records(bucket, uuid: str) -> Optional[List[Dict[str, Any]]]:
+    """
+    GCSからベクトルデータを読み込み、各レコードの embedding に行列の行（ndarray）を設定して返す。
+    ファイルが存在しない場合はNoneを返す。
+    """
+    loaded = load_store(bucket, uuid)
+    if loaded is None:
+        return None
+    metadata, matrix = loaded
+    records: List[Dict[str, Any]] = []
+    for item in metadata:
+        record = {key: value for key, value in item.items() if key != "embedding_index"}
+        index = item.get("embedding_index")
+        record["embedding"] = matrix[index] if index is not None else None
+        records.append(record)
+    return records
+
+
+def _write_store(bucket, name: str, records: List[Dict[str, Any]]) -> None:
+    """
+    レコード一覧を {name}.json と {name}.npy に分けてGCSへ保存する。
+    読み手が新しいJSONと古い行列を組み合わせないよう、行列を先にアップロードし、そのチェックサムをJSONに付ける。
+    """
+    metadata, vectors = _split_rows(records)
+    checksum = _upload_rows(bucket.blob(matrix_blob_name(name)), vectors)
+    _upload_metadata(bucket.blob(metadata_blob_name(name)), metadata, matrix_checksum=checksum)
+
+
+def _delete_blobs(bucket, blobs: List[Any]) -> None:
+    """オブジェクトをまとめて削除する。2件以上はバッチリクエストにまとめ、削除ごとの往復を省く。"""
+    if len(blobs) == 1:
+        blobs[0].delete()
+        return
+    for start in range(0, len(blobs), DELETE_BATCH_SIZE):
+        with bucket.client.batch():
+            for blob in blobs[start:start + DELETE_BATCH_SIZE]:
+                blob.delete()
+
+
+def delete_parts(bucket, uuid: str) -> bool:
+    """差分チェックポイントをすべて削除する。いずれかを削除した場合はTrueを返す。"""
+    blobs = list(bucket.list_blobs(prefix=part_blob_prefix(uuid)))
+    if blobs:
+        _delete_blobs(bucket, blobs)
+    return bool(blobs)
+
+
+def save_records(bucket, uuid: str, records: List[Dict[str, Any]]) -> None:
+    """
+    レコード一覧（全件）をメタデータJSONとnpy行列に分けてGCSへ保存する。
+    差分チェックポイントは全件に含まれるため先に削除する。削除後に中断した場合は差分の分だけ進捗が失われるが、
+    古い差分が新しい本体に重ねて読まれることはない。
+    """
+    delete_parts(bucket, uuid)
+    _write_store(bucket, uuid, records)
+
+
+def save_part(bucket, uuid: str, start: int, records: List[Dict[str, Any]]) -> None:
+    """保存済みのstart件の後ろに続くレコードを、差分チェックポイントとして保存する。"""
+    _write_store(bucket, part_name(uuid, start), records)
+
+
+def delete_store(bucket, uuid: str) -> bool:
+    """UUIDに紐づくメタデータJSONとnpy行列（差分チェックポイントを含む）を削除する。いずれかを削除した場合はTrueを返す。"""
+    blobs = list(bucket.list_blobs(prefix=part_blob_prefix(uuid)))
+    for name in (metadata_blob_name(uuid), matrix_blob_name(uuid)):
+        blob = bucket.blob(name)
+        if blob.exists():
+            blobs.append(blob)
+    if blobs:
+        _delete_blobs(bucket, blobs)
+    return bool(blobs)
@@ -0,0 +1,238 @@
+"""
+埋め込みAPIの制限に収まるよう画像を縮小するモジュール。
+
+ベクトル化ジョブ本体から切り離しておくことで、ProcessPoolExecutorのワーカーが
+環境変数の検証やクライアント初期化を伴わずにimportできる。
+"""
+
+import io
+import os
+import traceback
+from typing import Optional, Tuple
+
+from PIL import Image as PILImage
+
+# Decompression bomb対策: 最大画像ピクセル数を設定（約500MP）
+PILImage.MAX_IMAGE_PIXELS = 500_000_000
+
+MAX_IMAGE_SIZE_MB = 5
+MAX_FILE_SIZE_BYTES = MAX_IMAGE_SIZE_MB * 1024 * 1024
+MAX_PIXELS = 2_300_000
+
+FALLBACK_JPEG_QUALITY = 65
+
+# 縮小率がこの値の2倍以上あれば、先に整数倍のボックス縮小（Image.reduce）をかけてからLANCZOSで仕上げる。
+# 縮小率が最大でも約3.3倍（scale下限0.3）のため、Pillowで一般的な2.0や3.0では縮小が一度も入らない。
+# 既定の1.0は reduce(int(1/scale)) の後に残りをLANCZOSで縮小する形になる。出力は埋め込みモデルの入力にしか使わないため、
+# LANCZOSのみの結果との差（24MP→2.3MPでPSNR約46dB）よりも速度を優先する
+RESIZE_REDUCING_GAP = float(os.getenv("RESIZE_REDUCING_GAP", "1.0") or "1.0")
+# 縮小の途中経過（検出理由・スケール・出力品質など）を出力するか。大量の画像ではログ行が膨大になるため、既定では完了時の1行だけにする
+RESIZE_VERBOSE = os.getenv("RESIZE_VERBOSE", "false").lower() == "true"
+# Image.reduceが扱えるモード（I;16などは対象外）
+_REDUCIBLE_MODES = frozenset({'1', 'L', 'LA', 'RGB', 'RGBA', 'CMYK', 'I', 'F'})
+# draftで縮小デコードできる形式。スマートフォンやデジタルカメラの写真は複数画像を含むMPOとして開かれることが多い
+_DRAFT_FORMATS = frozenset({'JPEG', 'MPO'})
+
+# サイズ情報を持つJPEGのSOFマーカー（DHT・JPG・DACは同じ範囲にあるが対象外）
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+_PNG_IEND_CHUNK = b'IEND\xaeB`\x82'
+
+def _peek_jpeg_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """JPEGのマーカーをたどり、SOFセグメントから (幅, 高さ) を読む。見つからなければNone。"""
+    pos = 2
+    end = len(data)
+    while pos + 4 <= end:
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # マーカー前の埋め草
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            pos += 2
+            continue
+        if marker in (0xD9, 0xDA):
+            # SOFより先に画像データや終端が来た
+            return None
+        segment_length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+        if marker in _JPEG_SOF_MARKERS:
+            if pos + 9 > end:
+                return None
+            height = int.from_bytes(data[pos + 5:pos + 7], 'big')
+            width = int.from_bytes(data[pos + 7:pos + 9], 'big')
+            return width, height
+        pos += 2 + segment_length
+    return None
+
+def peek_image_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    JPEGとPNGのヘッダーだけを読み、(幅, 高さ) を返す。
+    末尾が終端マーカー（JPEGのEOI・PNGのIENDチャンク）で終わらないデータや、その他の形式はNoneを返す。
+    """
+    if data[:2] == b'\xff\xd8' and data[-2:] == b'\xff\xd9':
+        return _peek_jpeg_size(data)
+    if data[:8] == _PNG_SIGNATURE and data[12:16] == b'IHDR' and data.endswith(_PNG_IEND_CHUNK):
+        width = int.from_bytes(data[16:20], 'big')
+        height = int.from_bytes(data[20:24], 'big')
+        return width, height
+    return None
+
+def can_use_unchanged(image_content: bytes) -> bool:
+    """
+    ヘッダーから読んだ解像度とファイルサイズが上限内で、縮小せずにそのまま送れる画像かを判定する。
+    Falseの場合も縮小が必要とは限らず、resize_image_if_neededで改めて判定する。
+    """
+    if len(image_content) > MAX_FILE_SIZE_BYTES:
+        return False
+    size = peek_image_size(image_content)
+    return size is not None and 0 < size[0] * size[1] <= MAX_PIXELS
+
+def _encode_jpeg(img: PILImage.Image, quality: int) -> bytes:
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+def _open_error_reason(error: Exception, filename: str) -> str:
+    """画像を開く・検証する・デコードする際の例外を、スキップ理由に変換する。"""
+    if isinstance(error, PILImage.DecompressionBombError):
+        print(f"    ⚠️  '{filename}' でDecompression bomb警告が発生: {error}")
+        print("       画像が極端に大きいか破損している可能性があるためスキップします。")
+        return "decompression_bomb"
+    if isinstance(error, OSError):
+        print(f"    ⚠️  画像ファイル '{filename}' を判別できません: {error}")
+        print("       画像でないか破損している可能性があるためスキップします。")
+        return "cannot_identify"
+    print(f"    ⚠️  画像 '{filename}' の読み込み中に想定外のエラー: {error}")
+    return "open_error"
+
+def resize_image_if_needed(image_content: bytes, filename: str) -> Tuple[Optional[bytes], Optional[str]]:
+    """
+    画像の解像度が埋め込みAPIの制限を超える場合、ピクセル数ベースでリサイズする。
+    解像度が制限内でもファイルサイズが上限を超える場合（非圧縮に近いPNGなど）は、縮小せずJPEGに再エンコードする。
+    """
+    # ヘッダーだけで上限内と分かる画像はPILで開かずにそのまま返す
+    if can_use_unchanged(image_content):
+        return image_content, None
+    try:
+        source = io.BytesIO(image_content)
+        try:
+            # Image.openはヘッダーだけを読むため、サイズの取得にピクセルのデコードは伴わない
+            img = PILImage.open(source)
+            original_width, original_height = img.size
+        except Exception as e:
+            return None, _open_error_reason(e, filename)
+            
+        original_pixels = original_width * original_height
+        original_size_mb = len(image_content) / (1024 * 1024)
+        
+        if original_pixels > 100_000_000:
+            print(f"    ⚠️  超高解像度画像を検出: {original_width}x{original_height} ({original_pixels:,} pixels)")
+            print("       安全に処理できないためスキップします。")
+            return None, "too_large"
+        
+        if original_pixels <= MAX_PIXELS:
+            if len(image_content) <= MAX_FILE_SIZE_BYTES:
+                # 縮小しない画像はデコードしないため、verifyで破損だけを確認してそのまま返す
+                try:
+                    img.verify()
+                except Exception as e:
+                    return None, _open_error_reason(e, filename)
+                return image_content, None
+            if RESIZE_VERBOSE:
+                print(f"    📦 ファイルサイズが上限を超えています: {original_size_mb:.1f}MB > {MAX_IMAGE_SIZE_MB}MB")
+                print(f"       解像度 {original_width}x{original_height} のままJPEGに再エンコードします")
+            scale_factor = 1.0
+        else:
+            if RESIZE_VERBOSE:
+                print(f"    📏 高解像度画像を検出: {original_width}x{original_height} ({original_pixels:,} pixels > {MAX_PIXELS:,})")
+                print(f"       ファイルサイズ: {original_size_mb:.1f}MB")
+            scale_factor = (MAX_PIXELS / original_pixels) ** 0.5
+            scale_factor = max(0.3, scale_factor)
+        
+        new_width = int(original_width * scale_factor)
+        new_height = int(original_height * scale_factor)
+        new_pixels = new_width * new_height
+        
+        if RESIZE_VERBOSE:
+            print(f"    🔢 縮小スケール: {scale_factor:.3f}")
+            print(f"       変換後の解像度: {new_width}x{new_height} ({new_pixels:,} pixels)")
+        
+        # JPEG（MPOを含む）はデコード時にDCT領域で1/2・1/4・1/8へ縮小させ、フル解像度の展開を避ける。
+        # draftは目標サイズ以上に収まる範囲でしか縮小しないため、最終的なサイズはこの後のresizeで合わせる。
+        if img.format in _DRAFT_FORMATS:
+            img.draft('RGB', (new_width, new_height))
+        # 縮小する画像はverifyを使わず、デコード自体で破損を検出する（verify後は開き直しが必要になるため）
+        try:
+            img.load()
+        except Exception as e:
+            return None, _open_error_reason(e, filename)
+        
+        # パレット画像はそのままだとNEARESTでしか縮小されないため、先にRGBへ変換する。
+        # 透過色を持つ場合はRGBにすると透過部分がパレットの色（多くは黒）になるため、RGBAにして後段で白と合成する
+        if img.mode == 'P':
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        elif img.mode == 'PA':
+            img = img.convert('RGBA')
+
+        if (new_width, new_height) == img.size:
+            resized_img = img
+        else:
+            reducing_gap = RESIZE_REDUCING_GAP if img.mode in _REDUCIBLE_MODES else None
+            resized_img = img.resize((new_width, new_height), PILImage.Resampling.LANCZOS, reducing_gap=reducing_gap)
+
+        # 透過の合成は縮小後の小さい画像に対して行う。アルファが全面不透明なら合成せず変換だけで済ませる。
+        # グレースケール（LA）はRGBに広げず1チャンネルのまま合成し、JPEGのエンコード量と出力サイズを抑える
+        if resized_img.mode in ('RGBA', 'LA'):
+            flat_mode = 'L' if resized_img.mode == 'LA' else 'RGB'
+            alpha = resized_img.getchannel('A')
+            if alpha.getextrema() == (255, 255):
+                resized_img = resized_img.convert(flat_mode)
+            else:
+                background = PILImage.new(flat_mode, resized_img.size, 'white')
+                background.paste(resized_img.convert(flat_mode), mask=alpha)
+                resized_img = background
+        # 16bit画像などJPEGで保存できないモードはRGBにそろえる
+        if resized_img.mode not in ('RGB', 'L', 'CMYK'):
+            resized_img = resized_img.convert('RGB')
+        
+        # 2.3MP程度のJPEGが上限を超えることはまれなため、まずは高品質で1回だけエンコードし、
+        # 超えた場合のみ品質を下げて1回だけ再エンコードする（optimizeは2パス目の符号化になるため使わない）
+        quality = 90
+        resized_data = _encode_jpeg(resized_img, quality)
+        if len(resized_data) > MAX_FILE_SIZE_BYTES:
+            quality = FALLBACK_JPEG_QUALITY
+            resized_data = _encode_jpeg(resized_img, quality)
+        resized_size_mb = len(resized_data) / (1024 * 1024)
+        
+        if RESIZE_VERBOSE:
+            print(f"    ✅ リサイズ完了: {original_size_mb:.1f}MB -> {resized_size_mb:.1f}MB")
+            print(f"       解像度: {original_width}x{original_height} -> {new_width}x{new_height}")
+            print(f"       出力品質: {quality}")
+        else:
+            print(
+                f"    ✅ リサイズ完了: {original_width}x{original_height} -> {new_width}x{new_height}, "
+                f"{original_size_mb:.1f}MB -> {resized_size_mb:.1f}MB (品質 {quality})"
+            )
+        
+        return resized_data, None
+        
+    except Exception as e:
+        print(f"    ❌ リサイズ中にエラーが発生: {e}")
+        traceback.print_exc()
+        return None, "resize_failure"
+
+
+def resize_image_in_worker(image_content: bytes, filename: str) -> Tuple[Optional[bytes], Optional[str], bool]:
+    """
+    プロセスプールから呼び出すためのresize_image_if_needed。
+    縮小が不要だった場合は元の画像データを親プロセスへ送り返さず、3番目の値Trueで知らせる。
+
+    戻り値:
+        (縮小後のデータ, エラー理由, 元データをそのまま使うかどうか) のタプル
+    """
+    resized_content, error = resize_image_if_needed(image_content, filename)
+    if resized_content is image_content:
+        return None, None, True
+    return resized_content, error, False
@@ -1,26 +1,35 @@
+import atexit
 import os
-import io
+import hashlib
 import json
 import traceback
 import signal
 import sys
+import time
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from typing import Optional, Tuple
+from typing import Iterator, Optional, Tuple
 
 import numpy as np
 from dotenv import load_dotenv
 from google.cloud import storage
-from PIL import Image as PILImage
 
-from embedding_providers import get_embedding_provider
-
-# Decompression bomb対策: 最大画像ピクセル数を設定（約500MP）
-PILImage.MAX_IMAGE_PIXELS = 500_000_000
+from embedding_cache import EmbeddingCache, make_cache_key, make_text_cache_key, open_cache
+from embedding_providers import PartialEmbeddingError, get_embedding_provider
+from embedding_store import count_parts, load_records, save_part, save_records
+from image_resizer import can_use_unchanged, resize_image_in_worker
 
 import google.auth
-from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
-from drive_scanner import list_files_in_drive_folder
+from drive_scanner import DRIVE_NUM_RETRIES, get_thread_drive_service, list_files_in_drive_folder
+
+try:
+    import blake3  # type: ignore
+except ImportError:  # pragma: no cover
+    blake3 = None
 
 load_dotenv()
 
@@ -38,14 +47,52 @@ else:
     DRIVE_URL = os.getenv("DRIVE_URL")
     USE_EMBED_V4 = os.getenv("USE_EMBED_V4", "false").lower() == "true"
 
+# Cloud Run Jobsで複数タスクとして起動された場合、自分の担当分だけを処理する
+TASK_INDEX = int(os.getenv("CLOUD_RUN_TASK_INDEX", "0") or "0")
+TASK_COUNT = max(1, int(os.getenv("CLOUD_RUN_TASK_COUNT", "1") or "1"))
+
 GCS_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
 COHERE_API_KEY = os.getenv("COHERE_API_KEY")
 GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID")
 GCP_REGION = os.getenv("GCP_REGION", "asia-northeast1")
 VERTEX_MULTIMODAL_MODEL = os.getenv("VERTEX_MULTIMODAL_MODEL", "multimodalembedding@001")
 EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "cohere").lower()
-MAX_IMAGE_SIZE_MB = 5
+# ダウンロード前にDriveの報告サイズで弾く上限。これを超える画像はダウンロードと展開のコストに見合わないため取得しない
+MAX_SOURCE_FILE_SIZE_MB = float(os.getenv("MAX_SOURCE_FILE_SIZE_MB", "50") or "50")
 CHECKPOINT_INTERVAL = 100
+# 全件を書き直さず差分の追加だけで済ませる、差分チェックポイントの数の上限（途中のチェックポイントと最終保存の両方に適用）。
+# 読み込みのたびに差分ごとの取得が増えるため、上限に達したら全件を保存して1つにまとめ直す
+CHECKPOINT_MAX_PARTS = 8
+# 保存のたびに全件を書き直すため、短時間に連続したチェックポイントはまとめる
+CHECKPOINT_MIN_INTERVAL_SECONDS = 30
+PROGRESS_LOG_INTERVAL_SECONDS = 5.0
+
+def _available_cpu_count() -> int:
+    """
+    このプロセスが実行できるCPU数を返す。
+    os.cpu_count()はホスト全体のCPU数を返すため、CPUセットが制限されたコンテナでは割り当てを優先する。
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+RESIZE_WORKERS = int(os.getenv("RESIZE_WORKERS", "0") or "0") or _available_cpu_count()
+# Driveから並列にダウンロードするスレッド数（先読みするファイル数はこの2倍まで）
+DOWNLOAD_WORKERS = max(1, int(os.getenv("DOWNLOAD_WORKERS", "16") or "16"))
+# 先読み中のファイルの合計サイズ（Driveの報告値）の上限。大きなファイルが続いてもメモリを使い切らないようにする
+DOWNLOAD_PREFETCH_MB = float(os.getenv("DOWNLOAD_PREFETCH_MB", "256") or "256")
+DOWNLOAD_PREFETCH_BYTES = int(DOWNLOAD_PREFETCH_MB * 1024 * 1024)
+# 埋め込みAPIへまとめて送る画像の件数
+EMBED_BATCH_SIZE = max(1, int(os.getenv("EMBED_BATCH_SIZE", "16") or "16"))
+# 結果の受け取りを待たずに埋め込みAPIへ送っておけるバッチ数（超えた場合は古いバッチの完了を待つ）
+EMBED_PIPELINE_DEPTH = max(1, int(os.getenv("EMBED_PIPELINE_DEPTH", "2") or "2"))
+# 画像内容をキーにした埋め込みキャッシュ。EMBEDDING_CACHE_PATHかEMBEDDING_CACHE_BLOBを指定した場合だけ有効にする。
+# Cloud Run Jobsの/tmpはメモリ上にあり、キャッシュ（1枚あたりfloat32のベクトル2本）がタスクのメモリ上限を消費するため既定では使わない。
+# GCSオブジェクト名を指定すると実行間で共有する（パスを省略した場合は/tmpに置く）
+EMBEDDING_CACHE_BLOB = os.getenv("EMBEDDING_CACHE_BLOB", "")
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "") or (
+    "/tmp/embedding_cache.sqlite3" if EMBEDDING_CACHE_BLOB else ""
+)
 
 if BATCH_MODE:
     required_vars = ['GCS_BUCKET_NAME', 'GCP_PROJECT_ID']
@@ -64,87 +111,198 @@ if EMBEDDING_PROVIDER == "cohere" and not COHERE_API_KEY:
     raise RuntimeError("FATAL: COHERE_API_KEY must be set when EMBEDDING_PROVIDER=cohere")
 
 storage_client = storage.Client()
+_embedding_cache: Optional[EmbeddingCache] = None
+_embed_executor: Optional[ThreadPoolExecutor] = None
+_download_pool: Optional[ThreadPoolExecutor] = None
+_drive_creds = None
+_resize_pool: Optional[ProcessPoolExecutor] = None
+_checkpoint_executor: Optional[ThreadPoolExecutor] = None
 
-MAX_FILE_SIZE_BYTES = MAX_IMAGE_SIZE_MB * 1024 * 1024
+MAX_SOURCE_FILE_SIZE_BYTES = int(MAX_SOURCE_FILE_SIZE_MB * 1024 * 1024)
 
-def resize_image_if_needed(image_content: bytes, filename: str) -> Tuple[Optional[bytes], Optional[str]]:
+def check_source_file_size(file_info: dict) -> Optional[str]:
     """
-    画像の解像度が埋め込みAPIの制限を超える場合、ピクセル数ベースでリサイズする。
+    Driveの一覧取得で得たサイズから、ダウンロードする前に処理対象外のファイルを判定する。
+    
+    戻り値:
+        スキップ理由（対象外の場合）またはNone。サイズが不明な場合は判定せずNoneを返す
     """
     try:
+        size = int(file_info.get('size'))
+    except (TypeError, ValueError):
+        return None
+    if size == 0:
+        return "empty_file"
+    if size > MAX_SOURCE_FILE_SIZE_BYTES:
+        return "file_too_large"
+    return None
+
+def build_corrupt_entry(file_info: dict, reason: str, file_hash: Optional[str] = None) -> dict:
+    """処理できなかったファイルを再処理しないよう、ベクトルなしのエントリとして記録する。"""
+    return {
+        "filename": file_info['name'],
+        "filepath": file_info.get('webViewLink'),
+        "folder_path": file_info.get('folder_path'),
+        "embedding": None,
+        "file_hash": file_hash,
+        "is_corrupt": True,
+        "corrupt_reason": reason,
+    }
+
+def build_embedding_entry(file_info: dict, embedding: np.ndarray, file_hash: str) -> dict:
+    # チェックポイントのたびにPythonのfloatリストから行列を組み直さないよう、float32のndarrayのまま保持する
+    return {
+        "filename": file_info['name'],
+        "filepath": file_info['webViewLink'],
+        "folder_path": file_info['folder_path'],
+        "embedding": np.asarray(embedding, dtype=np.float32),
+        "file_hash": file_hash,
+        "is_corrupt": False,
+    }
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """埋め込みキャッシュを開く（初回のみ）。無効化されている場合や開けない場合はNoneを返す。"""
+    global _embedding_cache
+    if _embedding_cache is None and EMBEDDING_CACHE_PATH:
         try:
-            img = PILImage.open(io.BytesIO(image_content))
-            img.verify()
-            img = PILImage.open(io.BytesIO(image_content))
-        except PILImage.DecompressionBombError as e:
-            print(f"    ⚠️  '{filename}' でDecompression bomb警告が発生: {e}")
-            print("       画像が極端に大きいか破損している可能性があるためスキップします。")
-            return None, "decompression_bomb"
-        except OSError as e:
-            print(f"    ⚠️  画像ファイル '{filename}' を判別できません: {e}")
-            print("       画像でないか破損している可能性があるためスキップします。")
-            return None, "cannot_identify"
+            bucket = storage_client.bucket(GCS_BUCKET_NAME) if EMBEDDING_CACHE_BLOB else None
+            _embedding_cache = open_cache(EMBEDDING_CACHE_PATH, bucket, EMBEDDING_CACHE_BLOB)
         except Exception as e:
-            print(f"    ⚠️  画像 '{filename}' の読み込み中に想定外のエラー: {e}")
-            return None, "open_error"
-            
-        original_width, original_height = img.size
-        original_pixels = original_width * original_height
-        original_size_mb = len(image_content) / (1024 * 1024)
-        
-        if original_pixels > 100_000_000:
-            print(f"    ⚠️  超高解像度画像を検出: {original_width}x{original_height} ({original_pixels:,} pixels)")
-            print("       安全に処理できないためスキップします。")
-            return None, "too_large"
-        
-        MAX_PIXELS = 2_300_000
-        
-        if original_pixels <= MAX_PIXELS:
-            return image_content, None
-        
-        print(f"    📏 高解像度画像を検出: {original_width}x{original_height} ({original_pixels:,} pixels > {MAX_PIXELS:,})")
-        print(f"       ファイルサイズ: {original_size_mb:.1f}MB")
-        
-        if img.mode in ('RGBA', 'LA', 'P'):
-            background = PILImage.new('RGB', img.size, (255, 255, 255))
-            background.paste(img, mask=img.split()[-1] if 'A' in img.mode else None)
-            img = background
+            print(f"⚠️  埋め込みキャッシュを開けないため、キャッシュなしで続行します: {e}")
+            return None
+    return _embedding_cache
 
-        scale_factor = (MAX_PIXELS / original_pixels) ** 0.5
-        scale_factor = max(0.3, scale_factor)
-        
-        new_width = int(original_width * scale_factor)
-        new_height = int(original_height * scale_factor)
-        new_pixels = new_width * new_height
-        
-        print(f"    🔢 縮小スケール: {scale_factor:.3f}")
-        print(f"       変換後の解像度: {new_width}x{new_height} ({new_pixels:,} pixels)")
-        
-        resized_img = img.resize((new_width, new_height), PILImage.Resampling.LANCZOS)
-        
-        output = io.BytesIO()
-        resized_img.save(output, format='JPEG', quality=90, optimize=True)
-        resized_data = output.getvalue()
-        resized_size_mb = len(resized_data) / (1024 * 1024)
-        
-        quality = 90
-        while len(resized_data) > MAX_FILE_SIZE_BYTES and quality >= 60:
-            quality -= 10
-            output = io.BytesIO()
-            resized_img.save(output, format='JPEG', quality=quality, optimize=True)
-            resized_data = output.getvalue()
-            resized_size_mb = len(resized_data) / (1024 * 1024)
-        
-        print(f"    ✅ リサイズ完了: {original_size_mb:.1f}MB -> {resized_size_mb:.1f}MB")
-        print(f"       解像度: {original_width}x{original_height} -> {new_width}x{new_height}")
-        print(f"       出力品質: {quality}")
-        
-        return resized_data, None
-        
+def sync_embedding_cache() -> None:
+    """キャッシュの統計を出力し、GCSオブジェクトが指定されていればアップロードする。"""
+    if _embedding_cache is None:
+        return
+    stats = _embedding_cache.stats()
+    print(f"🗃️  埋め込みキャッシュ: ヒット {stats['hits']} 件 / ミス {stats['misses']} 件")
+    if not EMBEDDING_CACHE_BLOB:
+        return
+    try:
+        _embedding_cache.upload(storage_client.bucket(GCS_BUCKET_NAME), EMBEDDING_CACHE_BLOB)
     except Exception as e:
-        print(f"    ❌ リサイズ中にエラーが発生: {e}")
-        traceback.print_exc()
-        return None, "resize_failure"
+        print(f"⚠️  埋め込みキャッシュのアップロードに失敗しました: {e}")
+
+def _create_resize_pool() -> ProcessPoolExecutor:
+    # ワーカーはスレッドを抱えた親プロセスをforkせず、spawnで起動する。spawnのワーカーは親の__main__モジュールを
+    # 読み込み直すため、ジョブはvectorize_job.pyから起動し、ワーカーがこのモジュールの初期化を繰り返さないようにする
+    return ProcessPoolExecutor(
+        max_workers=RESIZE_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+def submit_resize(image_content: bytes, filename: str) -> Future:
+    """
+    resize_image_in_workerをプロセスプールに投入する。
+    PILの処理はGILを保持する部分が多いため、別プロセスで実行してダウンロードや埋め込みと並行させる。
+    ワーカーが異常終了してプールが使えなくなった場合は作り直す。
+    ヘッダーだけで縮小不要と分かる画像は、画像データをワーカーへ送らずに完了済みのFutureを返す。
+    """
+    global _resize_pool
+    if can_use_unchanged(image_content):
+        future: Future = Future()
+        future.set_result((None, None, True))
+        return future
+    if _resize_pool is None:
+        _resize_pool = _create_resize_pool()
+    try:
+        return _resize_pool.submit(resize_image_in_worker, image_content, filename)
+    except BrokenProcessPool:
+        print("⚠️  リサイズ用プロセスプールが停止していたため再作成します")
+        _resize_pool = _create_resize_pool()
+        return _resize_pool.submit(resize_image_in_worker, image_content, filename)
+
+class _HashingDownloadSink:
+    """
+    MediaIoBaseDownloadの書き込み先。受信したチャンクをBytesIOへコピーせずそのまま保持し、到着順にハッシュを更新する。
+    チャンクサイズ（既定100MB）に収まるファイルは1チャンクで届くため、レスポンスのbytesをそのまま内容として返せる。
+    """
+
+    def __init__(self) -> None:
+        self.hasher, self.prefix = _new_file_hasher()
+        self.chunks = []
+
+    def write(self, data: bytes) -> int:
+        self.hasher.update(data)
+        self.chunks.append(data)
+        return len(data)
+
+    def getvalue(self) -> bytes:
+        if len(self.chunks) == 1:
+            return bytes(self.chunks[0])
+        return b"".join(self.chunks)
+
+def download_drive_file(drive_service, file_info: dict) -> Tuple[str, bytes]:
+    """Driveからファイルをダウンロードし、(ファイルハッシュ, ファイル内容) を返す。"""
+    request = drive_service.files().get_media(fileId=file_info['id'])
+    sink = _HashingDownloadSink()
+    downloader = MediaIoBaseDownload(sink, request)
+    done = False
+    while not done:
+        # 並列ダウンロード中にレート制限や一時的なエラーを受けても、そのファイルを失敗扱いにしない
+        _, done = downloader.next_chunk(num_retries=DRIVE_NUM_RETRIES)
+    return sink.prefix + sink.hasher.hexdigest(), sink.getvalue()
+
+def get_drive_credentials():
+    """Drive読み取り用の認証情報を返す（初回のみ取得し、以降のUUIDでも使い回す）。"""
+    global _drive_creds
+    if _drive_creds is None:
+        _drive_creds, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/drive.readonly'])
+    return _drive_creds
+
+def iter_drive_downloads(drive_creds, files: list) -> Iterator[Tuple[dict, Optional[str], Optional[bytes], Optional[Exception]]]:
+    """
+    filesを複数スレッドで並列にダウンロードし、元の順序で (file_info, ハッシュ, 内容, 例外) を返す。
+    メモリを抑えるため、先読みはDOWNLOAD_WORKERSの2倍の件数かつDOWNLOAD_PREFETCH_BYTESの合計サイズまでに制限する
+    （先読みが空の場合は上限を超えるファイルでも1件は取得する）。
+    スレッドプールとスレッドごとのDriveサービスはUUIDをまたいで使い回し、接続を張り直さない。
+    """
+    global _download_pool
+    if _download_pool is None:
+        _download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="drive-download")
+    pool = _download_pool
+
+    def fetch(file_info: dict) -> Tuple[str, bytes]:
+        return download_drive_file(get_thread_drive_service(drive_creds), file_info)
+
+    waiting = deque(files)
+    in_flight = deque()
+    in_flight_bytes = 0
+    while waiting or in_flight:
+        while waiting and len(in_flight) < DOWNLOAD_WORKERS * 2:
+            size = _reported_size(waiting[0])
+            if in_flight and in_flight_bytes + size > DOWNLOAD_PREFETCH_BYTES:
+                break
+            file_info = waiting.popleft()
+            in_flight.append((file_info, size, pool.submit(fetch, file_info)))
+            in_flight_bytes += size
+
+        file_info, size, future = in_flight.popleft()
+        in_flight_bytes -= size
+        try:
+            file_hash, content = future.result()
+        except Exception as e:
+            yield file_info, None, None, e
+            continue
+        yield file_info, file_hash, content, None
+
+def _reported_size(file_info: dict) -> int:
+    try:
+        return int(file_info.get('size') or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def _new_file_hasher():
+    """
+    ファイルハッシュ用のハッシュオブジェクトと、結果に付ける接頭辞を返す。
+    blake3パッケージがあればSIMDとマルチスレッドで高速なBLAKE3を使い、"blake3:"を付ける。
+    無い場合は従来どおり接頭辞なしのSHA-256とする（既存データのfile_hashと同じ形式）。
+    """
+    if blake3 is not None:
+        return blake3.blake3(max_threads=blake3.blake3.AUTO), "blake3:"
+    return hashlib.sha256(), ""
 
 def get_multimodal_embedding(image_bytes: bytes, filename: str, file_index: int = 0, use_embed_v4: bool = False) -> np.ndarray:
     """画像データとファイル名から重み付けされたベクトルを生成する"""
@@ -162,45 +320,232 @@ def get_multimodal_embedding(image_bytes: bytes, filename: str, file_index: int
         traceback.print_exc()
         return None
 
-def load_existing_embeddings(bucket_name: str, uuid: str) -> tuple:
-    """既存のembeddingsと処理済みファイルリストを読み込む"""
+def get_multimodal_embeddings_batch(items: list, use_embed_v4: bool = False) -> list:
+    """
+    (画像データ, ファイル名) のリストをまとめてベクトル化する。
+    一部の画像だけが失敗した場合はその要素をNoneとして残りを返す。
+    まとめての生成そのものに失敗した場合は1件ずつ生成し直し、失敗した要素はNoneとして返す。
+    """
+    try:
+        provider = get_embedding_provider()
+        matrix = provider.embed_multimodal_batch(
+            texts=[filename for _, filename in items],
+            images=[image_bytes for image_bytes, _ in items],
+            use_embed_v4=use_embed_v4,
+        )
+        return list(matrix)
+
+    except PartialEmbeddingError as e:
+        # 成功した画像を送り直さないよう、失敗した要素だけを欠損として扱う
+        print(f"    ⚠️  {e.failed_count} 件の画像の埋め込み生成に失敗したためスキップします: {e}")
+        return e.results
+
+    except Exception as e:
+        print(f"    ⚠️  {len(items)} 件のまとめての埋め込み生成に失敗したため1件ずつ再試行します: {e}")
+        return [
+            get_multimodal_embedding(image_bytes, filename, use_embed_v4=use_embed_v4)
+            for image_bytes, filename in items
+        ]
+
+def prefetch_filename_embeddings(filenames: list, use_embed_v4: bool, cache: Optional[EmbeddingCache]) -> None:
+    """
+    ファイル名（テキスト側）の埋め込みを先にまとめて取得する。
+    キャッシュがあれば以前の実行で得たベクトルをプロバイダへ登録してAPI呼び出しを省き、新たに取得した分をキャッシュへ保存する。
+    """
+    provider = get_embedding_provider()
+    keys = {}
+    cached = {}
+    if cache is not None:
+        model_id = provider.model_identifier(use_embed_v4)
+        keys = {name: make_text_cache_key(model_id, name) for name in filenames}
+        found = cache.get_many(keys.values())
+        cached = {name: found[key] for name, key in keys.items() if key in found}
+        if cached:
+            print(f"    🗃️  ファイル名の埋め込みをキャッシュから {len(cached)} 件再利用します")
+            provider.seed_document_texts(cached, use_embed_v4)
+    fetched = provider.prefetch_document_texts(filenames, use_embed_v4)
+    if cache is not None:
+        cache.put_many((keys[name], vector) for name, vector in fetched.items() if name not in cached)
+
+def submit_embeddings_batch(items: list, use_embed_v4: bool = False) -> Future:
+    """get_multimodal_embeddings_batchを埋め込み用のスレッドで実行し、Futureを返す。"""
+    global _embed_executor
+    if _embed_executor is None:
+        _embed_executor = ThreadPoolExecutor(max_workers=EMBED_PIPELINE_DEPTH, thread_name_prefix="embed-batch")
+    return _embed_executor.submit(get_multimodal_embeddings_batch, items, use_embed_v4)
+
+def load_existing_embeddings(bucket_name: str, uuid: str) -> list:
+    """既存のembeddingsを読み込む（処理済みかどうかの判定はcalculate_diffでフォルダパスとファイル名の組から行う）"""
     try:
         bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(f"{uuid}.json")
+        existing_data = load_records(bucket, uuid)
         
-        if blob.exists():
-            existing_data = json.loads(blob.download_as_text())
-            processed_files = {item['filename'] for item in existing_data}
+        if existing_data is not None:
             print(f"📂 既存データを {len(existing_data)} 件読み込みました")
-            return existing_data, processed_files
+            return existing_data
         else:
             print("📂 既存データが見つからなかったため新規作成します")
-            return [], set()
+            return []
     except Exception as e:
         print(f"⚠️  既存データの読み込みに失敗しました: {e}")
-        return [], set()
+        return []
 
-def save_checkpoint(bucket_name: str, uuid: str, embeddings: list, is_final: bool = False):
-    """チェックポイントとしてembeddingsを{uuid}.jsonに保存"""
+def save_checkpoint(bucket_name: str, uuid: str, embeddings: list, is_final: bool = False) -> bool:
+    """チェックポイントとしてembeddingsを{uuid}.json（メタデータ）と{uuid}.npy（行列）に保存し、成功したかを返す"""
     try:
-        from datetime import datetime
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
         bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(f"{uuid}.json")
-        blob.upload_from_string(
-            json.dumps(embeddings, ensure_ascii=False, indent=2),
-            content_type="application/json"
-        )
+        save_records(bucket, uuid, embeddings)
         
         if is_final:
             print(f"✅ [{current_time}] 最終保存完了: {len(embeddings)} 件を gs://{bucket_name}/{uuid}.json に保存しました")
         else:
             print(f"💾 [{current_time}] チェックポイント保存: {len(embeddings)} 件を gs://{bucket_name}/{uuid}.json に退避しました")
+        return True
             
     except Exception as e:
         print(f"❌ [{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] gs://{bucket_name}/{uuid}.json への保存に失敗しました: {e}")
         traceback.print_exc()
+        return False
+
+def save_checkpoint_part(bucket_name: str, uuid: str, start: int, records: list, is_final: bool = False) -> bool:
+    """保存済みのstart件に続いて追加されたrecordsだけを差分チェックポイントとして保存し、成功したかを返す"""
+    try:
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        bucket = storage_client.bucket(bucket_name)
+        save_part(bucket, uuid, start, records)
+        if is_final:
+            print(f"✅ [{current_time}] 最終保存完了: 差分 {len(records)} 件を追加し、計 {start + len(records)} 件を gs://{bucket_name}/{uuid}.part-* に保存しました")
+        else:
+            print(f"💾 [{current_time}] チェックポイント保存: 差分 {len(records)} 件を追加し、計 {start + len(records)} 件を gs://{bucket_name}/{uuid}.part-* に退避しました")
+        return True
+    except Exception as e:
+        print(f"❌ [{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] gs://{bucket_name}/{uuid} の差分チェックポイントの保存に失敗しました: {e}")
+        traceback.print_exc()
+        return False
+
+class CheckpointWriter:
+    """
+    処理中のembeddingsへの追加を記録し、GCSへのチェックポイント保存をまとめて行う。
+    
+    未保存の件数がCHECKPOINT_INTERVALに達し、かつ前回の保存からCHECKPOINT_MIN_INTERVAL_SECONDS以上経過した時だけ保存する。
+    途中のチェックポイントはその時点のリストの写しを専用スレッドでアップロードし、その間も処理を止めない
+    （前回のアップロードが終わっていなければ今回は見送る）。
+    embeddingsは末尾への追加しか行われないため、途中のチェックポイントではGCSに保存済みの件数より後ろだけを
+    差分として保存し、全件の書き直しを繰り返さない。保存済みの件数が分からない場合（saved_count=None）は全件を保存する。
+    差分の数がCHECKPOINT_MAX_PARTSに達したら、途中のチェックポイントでも全件を保存して1つにまとめ直す（読み込み時の取得回数を抑えるため）。
+    シグナル受信時や終了時はflush()で未保存分を差分として書き出す。save()は実行中のアップロードを待ってから同期的に全件を保存する（最終保存は差分の数がCHECKPOINT_MAX_PARTS未満なら差分の追加で済ませる）。
+    """
+    
+    def __init__(self, bucket_name: str, uuid: str, embeddings: list, saved_count: Optional[int] = None):
+        self.bucket_name = bucket_name
+        self.uuid = uuid
+        self.embeddings = embeddings
+        # GCS上の本体と差分に保存済みの、embeddingsの先頭からの件数
+        self._saved_count = saved_count
+        self._pending = 0
+        self._last_saved_at = time.monotonic()
+        self._in_flight: Optional[Future] = None
+        # GCS上の差分チェックポイントの数。Noneは未確認（初回の差分保存時にGCSで数える）
+        self._part_count: Optional[int] = None
+    
+    @property
+    def dirty(self) -> bool:
+        return self._pending > 0
+    
+    def mark_dirty(self, count: int = 1) -> None:
+        self._pending += count
+    
+    def maybe_save(self, processed: int, total: int) -> None:
+        if self._pending < CHECKPOINT_INTERVAL:
+            return
+        if time.monotonic() - self._last_saved_at < CHECKPOINT_MIN_INTERVAL_SECONDS:
+            return
+        if self._in_flight is not None and not self._in_flight.done():
+            return
+        global _checkpoint_executor
+        if _checkpoint_executor is None:
+            _checkpoint_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+        print(f"📌 チェックポイント: {total} 件中 {processed} 件処理済み")
+        print(f"💾 現在の埋め込み数: {len(self.embeddings)} 件")
+        self._in_flight = _checkpoint_executor.submit(self._write, list(self.embeddings))
+        self._pending = 0
+        self._last_saved_at = time.monotonic()
+    
+    def _write(self, records: list, compact: bool = True) -> None:
+        """
+        保存済みの件数より後ろを差分として保存する。保存済みの件数が分からない場合と、
+        compactが真で差分の数が上限に達している場合は全件を保存する。
+        """
+        start = self._saved_count
+        if start is not None and start >= len(records):
+            return
+        if start is None or (compact and not self._can_append_part()):
+            if save_checkpoint(self.bucket_name, self.uuid, records):
+                self._saved_count = len(records)
+                self._part_count = 0
+        elif save_checkpoint_part(self.bucket_name, self.uuid, start, records[start:]):
+            self._saved_count = len(records)
+            if self._part_count is not None:
+                self._part_count += 1
+    
+    def wait(self) -> None:
+        """バックグラウンドで実行中のチェックポイント保存があれば完了を待つ。"""
+        if self._in_flight is not None:
+            self._in_flight.result()
+            self._in_flight = None
+    
+    def _can_append_part(self) -> bool:
+        """全件の書き直しではなく差分の追加で済ませられるか（差分の数が上限未満か）を返す。"""
+        if self._saved_count is None:
+            return False
+        if self._part_count is None:
+            try:
+                self._part_count = count_parts(storage_client.bucket(self.bucket_name), self.uuid)
+            except Exception as e:
+                print(f"⚠️  差分チェックポイントの確認に失敗したため全件を保存します: {e}")
+                return False
+        return self._part_count < CHECKPOINT_MAX_PARTS
+    
+    def save(self, is_final: bool = False) -> None:
+        # 古い写しが後からアップロードされて新しい内容を上書きしないよう、実行中の保存を先に終わらせる
+        self.wait()
+        start = self._saved_count
+        if is_final and self._can_append_part():
+            # 既存の件数に比べて追加が少ない実行（Driveの変更通知による再実行など）で全件を書き直さない
+            if start < len(self.embeddings) and save_checkpoint_part(
+                self.bucket_name, self.uuid, start, self.embeddings[start:], is_final=True
+            ):
+                self._saved_count = len(self.embeddings)
+                self._part_count += 1
+        elif save_checkpoint(self.bucket_name, self.uuid, self.embeddings, is_final=is_final):
+            self._saved_count = len(self.embeddings)
+            self._part_count = 0
+        self._pending = 0
+        self._last_saved_at = time.monotonic()
+    
+    def flush(self) -> None:
+        if self.dirty:
+            # 終了までの猶予が短いため、全件ではなく未保存の差分だけを書き出す
+            self.wait()
+            self._write(list(self.embeddings), compact=False)
+            self._pending = 0
+
+_active_checkpoint: Optional[CheckpointWriter] = None
+
+def flush_active_checkpoint() -> None:
+    """処理中のUUIDに未保存の結果があれば保存する（シグナル受信時・プロセス終了時に呼ばれる）。"""
+    checkpoint = _active_checkpoint
+    if checkpoint is None or not checkpoint.dirty:
+        return
+    try:
+        checkpoint.flush()
+        print(f"✅ 緊急保存が完了しました: UUID {checkpoint.uuid} ({len(checkpoint.embeddings)} 件)")
+    except Exception as e:
+        print(f"❌ 緊急保存に失敗しました: {e}")
+
+atexit.register(flush_active_checkpoint)
 
 def calculate_diff(drive_files: list, existing_embeddings: list) -> tuple:
     """
@@ -213,8 +558,9 @@ def calculate_diff(drive_files: list, existing_embeddings: list) -> tuple:
     戻り値:
         追加対象ファイルのリストと、削除対象を示すキー集合のタプル
     """
-    # Google Driveの現在のファイルセット（フルパスで管理）
-    drive_file_keys = {f"{f.get('folder_path', '')}/{f['name']}" for f in drive_files}
+    # Google Driveの現在のファイルセット（フルパスで管理）。キーは追加対象の抽出でも使うため一度だけ組み立てる
+    drive_keys = [f"{f.get('folder_path', '')}/{f['name']}" for f in drive_files]
+    drive_file_keys = set(drive_keys)
     
     # ベクトルファイルの既存ファイルセット（フルパスで管理）
     vector_file_keys = {f"{item.get('folder_path', '')}/{item.get('filename', '')}" for item in existing_embeddings}
@@ -226,7 +572,7 @@ def calculate_diff(drive_files: list, existing_embeddings: list) -> tuple:
     keys_to_delete = vector_file_keys - drive_file_keys
     
     # 追加対象のファイル情報を抽出
-    files_to_add = [f for f in drive_files if f"{f.get('folder_path', '')}/{f['name']}" in keys_to_add]
+    files_to_add = [f for f, key in zip(drive_files, drive_keys) if key in keys_to_add]
     
     print("\n📊 差分解析結果:")
     print(f"   Drive側ファイル数: {len(drive_file_keys)}")
@@ -276,6 +622,7 @@ def remove_deleted_files(existing_embeddings: list, keys_to_delete: set) -> list
 
 def process_single_uuid(uuid: str, drive_url: str, use_embed_v4: bool = False, all_embeddings: list = None) -> list:
     """単一UUIDの処理（差分検出・削除機能付き）"""
+    global _active_checkpoint
     if all_embeddings is None:
         all_embeddings = []
     
@@ -285,7 +632,7 @@ def process_single_uuid(uuid: str, drive_url: str, use_embed_v4: bool = False, a
     
     try:
         # 既存のembeddingsを読み込む
-        existing_embeddings, _ = load_existing_embeddings(GCS_BUCKET_NAME, uuid)
+        existing_embeddings = load_existing_embeddings(GCS_BUCKET_NAME, uuid)
         drive_files = list_files_in_drive_folder(drive_url)
         if not drive_files:
             print(f"⚠️  Google Driveにファイルが見つかりません: UUID {uuid}")
@@ -300,9 +647,14 @@ def process_single_uuid(uuid: str, drive_url: str, use_embed_v4: bool = False, a
         # 削除処理を実行
         task_embeddings = remove_deleted_files(existing_embeddings, keys_to_delete)
         
+        # GCSに保存済みの件数。以降のチェックポイントはこれより後ろを差分として保存する。
+        # 本体のファイルが無い場合は検索側から見えるよう、最初のチェックポイントで全件を保存する
+        saved_count = len(task_embeddings) if task_embeddings else None
+
         # 削除が発生した場合は即座に保存
         if keys_to_delete:
-            save_checkpoint(GCS_BUCKET_NAME, uuid, task_embeddings, is_final=False)
+            if not save_checkpoint(GCS_BUCKET_NAME, uuid, task_embeddings, is_final=False):
+                saved_count = None
             print(f"💾 削除後の中間保存を実施: {len(task_embeddings)} 件")
         
         # 追加対象がない場合は終了
@@ -316,69 +668,236 @@ def process_single_uuid(uuid: str, drive_url: str, use_embed_v4: bool = False, a
         print(f"\n📝 新規ファイル {len(files_to_add)} 件の処理を開始します...")
         
         print("Google Driveサービスを初期化しています...")
-        drive_creds, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/drive.readonly'])
-        drive_service = build('drive', 'v3', credentials=drive_creds)
+        drive_creds = get_drive_credentials()
         
         start_time = datetime.now()
-        
-        for i, file_info in enumerate(files_to_add, 1):
-            print(f"    ({i}/{len(files_to_add)}) 処理中: {file_info['name'][:50]}...")
-            
+        last_progress_log = None
+        # ダウンロード → 縮小 → 埋め込みの各段を重ねて進めるため、縮小中・埋め込み中の項目を上限付きで保持する
+        resize_in_flight = deque()
+        embed_in_flight = deque()
+        checkpoint = CheckpointWriter(GCS_BUCKET_NAME, uuid, task_embeddings, saved_count)
+        _active_checkpoint = checkpoint
+
+        embed_batch = []
+        # 同じ内容・同じファイル名の画像（別フォルダへのコピーなど）は1回だけ埋め込む。
+        # 処理済みのものは結果の位置を、処理中のものは結果を待つ重複ファイルの一覧を保持する
+        completed_duplicates = {}
+        waiting_duplicates = {}
+        cache = get_embedding_cache()
+        model_id = get_embedding_provider().model_identifier(use_embed_v4) if cache is not None else None
+
+        def record_result(entry: dict, followers: list) -> None:
+            """結果を追加し、同じ画像の重複ファイルにも同じ結果を複製する。"""
+            completed_duplicates[(entry['file_hash'], entry['filename'])] = len(task_embeddings)
+            task_embeddings.append(entry)
+            for follower_info in followers:
+                task_embeddings.append(copy_entry_for(entry, follower_info))
+            checkpoint.mark_dirty(1 + len(followers))
+
+        def copy_entry_for(entry: dict, file_info: dict) -> dict:
+            return dict(
+                entry,
+                filename=file_info['name'],
+                filepath=file_info['webViewLink'],
+                folder_path=file_info['folder_path'],
+            )
+
+        def collect_embed_batch(batch: list, embed_future: Future) -> None:
+            """埋め込みの完了を待ち、結果に追加する。"""
             try:
-                request = drive_service.files().get_media(fileId=file_info['id'])
-                fh = io.BytesIO()
-                downloader = MediaIoBaseDownload(fh, request)
-                done = False
-                while not done:
-                    _, done = downloader.next_chunk()
-                image_content = fh.getvalue()
-                
-                resized_content, resize_error = resize_image_if_needed(image_content, file_info['name'])
+                embeddings = embed_future.result()
+            except Exception as e:
+                print(f"      ❌ {len(batch)} 件の埋め込み生成中にエラー: {e}")
+                for _, item_info, item_hash, _, _ in batch:
+                    waiting_duplicates.pop((item_hash, item_info['name']), None)
+                return
+            cache_entries = []
+            for (index, item_info, item_hash, _, payload_key), embedding in zip(batch, embeddings):
+                followers = waiting_duplicates.pop((item_hash, item_info['name']), [])
+                if embedding is None:
+                    continue
+                record_result(build_embedding_entry(item_info, embedding, item_hash), followers)
+                if cache is not None:
+                    cache_entries.append((make_cache_key(model_id, item_hash, item_info['name']), embedding))
+                    if payload_key is not None:
+                        cache_entries.append((payload_key, embedding))
+            if cache_entries:
+                try:
+                    cache.put_many(cache_entries)
+                except Exception as e:
+                    print(f"      ⚠️  埋め込みキャッシュへの保存に失敗しました: {e}")
+            checkpoint.maybe_save(batch[-1][0], len(files_to_add))
+
+        def flush_embed_batch() -> None:
+            """溜めた画像を埋め込み用のスレッドへ送る。送信中のバッチが上限を超えたら古いものから受け取る。"""
+            if not embed_batch:
+                return
+            embed_future = submit_embeddings_batch(
+                [(resized_content, item_info['name']) for _, item_info, _, resized_content, _ in embed_batch],
+                use_embed_v4,
+            )
+            # 結果の受け取りには画像データを使わない。API呼び出しが終わった時点で画像が解放されるよう、
+            # 受け取りを待つ間に保持するバッチからは画像への参照を外しておく
+            batch = [(index, item_info, item_hash, None, payload_key) for index, item_info, item_hash, _, payload_key in embed_batch]
+            embed_batch.clear()
+            embed_in_flight.append((batch, embed_future))
+            while len(embed_in_flight) > EMBED_PIPELINE_DEPTH:
+                collect_embed_batch(*embed_in_flight.popleft())
+
+        def finish_pending(pending_item) -> None:
+            """縮小済みの画像を受け取り、埋め込み待ちのバッチに追加する。"""
+            index, pending_info, pending_hash, image_content, resize_future = pending_item
+            try:
+                resized_content, resize_error, unchanged = resize_future.result()
+                if unchanged:
+                    resized_content = image_content
                 if resized_content is None:
                     reason_text = resize_error or "unknown_error"
                     print(f"      ⭕️  リサイズできないためスキップします ({reason_text})")
-                    error_entry = {
-                        "filename": file_info['name'],
-                        "filepath": file_info.get('webViewLink'),
-                        "folder_path": file_info.get('folder_path'),
-                        "embedding": None,
-                        "is_corrupt": True,
-                        "corrupt_reason": reason_text,
-                    }
-                    task_embeddings.append(error_entry)
-                    continue
+                    followers = waiting_duplicates.pop((pending_hash, pending_info['name']), [])
+                    record_result(build_corrupt_entry(pending_info, reason_text, pending_hash), followers)
+                    return
 
-                embedding = get_multimodal_embedding(resized_content, file_info['name'], i, use_embed_v4)
-                if embedding is not None:
-                    result_data = {
-                        "filename": file_info['name'],
-                        "filepath": file_info['webViewLink'],
-                        "folder_path": file_info['folder_path'],
-                        "embedding": embedding.tolist(),
-                        "is_corrupt": False,
-                    }
-                    task_embeddings.append(result_data)
-                    
-                    if i % CHECKPOINT_INTERVAL == 0:
-                        print(f"📌 チェックポイント: {len(files_to_add)} 件中 {i} 件処理済み")
-                        save_checkpoint(GCS_BUCKET_NAME, uuid, task_embeddings, is_final=False)
-                        print(f"💾 現在の埋め込み数: {len(task_embeddings)} 件")
+                payload_key = None
+                if cache is not None and not unchanged:
+                    # 縮小後の画像はJPEGへ再エンコードされ、元ファイルの形式やメタデータの違いが消える。
+                    # APIへ送る内容が同じなら埋め込みも同じなので、元ファイルのハッシュが異なっても過去の結果を再利用する
+                    payload_key = make_cache_key(model_id, "resized:" + hashlib.sha256(resized_content).hexdigest(), pending_info['name'])
+                    cached_embedding = cache.get(payload_key)
+                    if cached_embedding is not None:
+                        followers = waiting_duplicates.pop((pending_hash, pending_info['name']), [])
+                        record_result(build_embedding_entry(pending_info, cached_embedding, pending_hash), followers)
+                        try:
+                            cache.put_many([(make_cache_key(model_id, pending_hash, pending_info['name']), cached_embedding)])
+                        except Exception as e:
+                            print(f"      ⚠️  埋め込みキャッシュへの保存に失敗しました: {e}")
+                        return
+
+                embed_batch.append((index, pending_info, pending_hash, resized_content, payload_key))
+                if len(embed_batch) >= EMBED_BATCH_SIZE:
+                    flush_embed_batch()
+
+            except Exception as e:
+                waiting_duplicates.pop((pending_hash, pending_info['name']), None)
+                print(f"      ❌ {pending_info['name']} の処理中にエラー: {e}")
+        
+        # サイズで弾けるファイルはダウンロードせずに先に記録する
+        downloadable_files = []
+        for file_info in files_to_add:
+            size_error = check_source_file_size(file_info)
+            if size_error is not None:
+                print(f"      ⏭️  '{file_info['name']}' はダウンロード前にスキップします ({size_error}, size={file_info.get('size')})")
+                task_embeddings.append(build_corrupt_entry(file_info, size_error))
+                checkpoint.mark_dirty()
+            else:
+                downloadable_files.append(file_info)
 
+        # Driveが返すMD5が以前にダウンロードしたファイルと一致し、その埋め込みもキャッシュにあれば、ダウンロード自体を省く
+        checksum_hashes = []
+        if cache is not None:
+            try:
+                known_hashes = cache.get_file_hashes(
+                    file_info['md5Checksum'] for file_info in downloadable_files if file_info.get('md5Checksum')
+                )
+                candidates = []
+                for file_info in downloadable_files:
+                    known_hash = known_hashes.get(file_info.get('md5Checksum'))
+                    key = make_cache_key(model_id, known_hash, file_info['name']) if known_hash is not None else None
+                    candidates.append((file_info, known_hash, key))
+                found = cache.get_many(key for _, _, key in candidates if key is not None)
+                remaining_files = []
+                for file_info, known_hash, key in candidates:
+                    cached_embedding = found.get(key) if key is not None else None
+                    if cached_embedding is None:
+                        remaining_files.append(file_info)
+                        continue
+                    record_result(build_embedding_entry(file_info, cached_embedding, known_hash), [])
+                if len(remaining_files) < len(downloadable_files):
+                    print(f"    🗃️  Driveのチェックサムが一致する {len(downloadable_files) - len(remaining_files)} 件はダウンロードせずキャッシュを再利用します")
+                downloadable_files = remaining_files
+            except Exception as e:
+                print(f"    ⚠️  チェックサムによるキャッシュの確認に失敗しました: {e}")
+        skipped_count = len(files_to_add) - len(downloadable_files)
+
+        # ファイル名は一覧の時点で分かっているため、テキスト側の埋め込みは最初にまとめて取得しておく
+        try:
+            prefetch_filename_embeddings(
+                [file_info['name'] for file_info in downloadable_files],
+                use_embed_v4,
+                cache,
+            )
+        except Exception as e:
+            print(f"    ⚠️  ファイル名の埋め込みの事前取得に失敗したため、画像ごとに取得します: {e}")
+
+        downloads = iter_drive_downloads(drive_creds, downloadable_files)
+        for i, (file_info, file_hash, image_content, download_error) in enumerate(downloads, skipped_count + 1):
+            # 1件ごとに出力するとログ行が膨大になるため、進捗表示は一定間隔に間引く
+            now = time.monotonic()
+            if last_progress_log is None or now - last_progress_log >= PROGRESS_LOG_INTERVAL_SECONDS or i == len(files_to_add):
+                print(f"    ({i}/{len(files_to_add)}) 処理中: {file_info['name'][:50]}...")
+                last_progress_log = now
+            
+            if download_error is not None:
+                print(f"      ❌ {file_info['name']} の処理中にエラー: {download_error}")
+                continue
+            if cache is not None and file_info.get('md5Checksum'):
+                checksum_hashes.append((file_info['md5Checksum'], file_hash))
+
+            try:
+                duplicate_key = (file_hash, file_info['name'])
+                if duplicate_key in completed_duplicates:
+                    task_embeddings.append(copy_entry_for(task_embeddings[completed_duplicates[duplicate_key]], file_info))
+                    checkpoint.mark_dirty()
+                    continue
+                if duplicate_key in waiting_duplicates:
+                    waiting_duplicates[duplicate_key].append(file_info)
+                    continue
+
+                if cache is not None:
+                    cached_embedding = cache.get(make_cache_key(model_id, file_hash, file_info['name']))
+                    if cached_embedding is not None:
+                        # 同じ内容・同じファイル名の画像は過去の埋め込みを再利用し、縮小とAPI呼び出しを省く
+                        record_result(build_embedding_entry(file_info, cached_embedding, file_hash), [])
+                        continue
+                # 縮小は別プロセスで行い、その間に他のファイルの埋め込みと後続のダウンロードを進める
+                resize_future = submit_resize(image_content, file_info['name'])
+                waiting_duplicates[duplicate_key] = []
             except Exception as e:
                 print(f"      ❌ {file_info['name']} の処理中にエラー: {e}")
                 continue
+
+            resize_in_flight.append((i, file_info, file_hash, image_content, resize_future))
+            while len(resize_in_flight) > RESIZE_WORKERS:
+                finish_pending(resize_in_flight.popleft())
+
+        while resize_in_flight:
+            finish_pending(resize_in_flight.popleft())
+        flush_embed_batch()
+        while embed_in_flight:
+            collect_embed_batch(*embed_in_flight.popleft())
+        if checksum_hashes:
+            try:
+                cache.put_file_hashes(checksum_hashes)
+            except Exception as e:
+                print(f"      ⚠️  チェックサムの対応表の保存に失敗しました: {e}")
         
         # タスク完了後にファイルを保存
         if task_embeddings != existing_embeddings or keys_to_delete:
             elapsed_total = (datetime.now() - start_time).total_seconds()
             print(f"   ⏱️  UUID {uuid} の処理時間: {elapsed_total:.1f} 秒")
-            save_checkpoint(GCS_BUCKET_NAME, uuid, task_embeddings, is_final=True)
+            checkpoint.save(is_final=True)
             print(f"   ✅ UUID {uuid} 用に {len(task_embeddings)} 件保存しました")
             print(f"   📊 変化量: 追加 {len(files_to_add)} 件 / 削除 {len(keys_to_delete)} 件")
         
+        checkpoint.wait()
+        _active_checkpoint = None
         return task_embeddings
         
     except Exception as e:
+        if _active_checkpoint is not None:
+            # バックグラウンドの保存が緊急保存の後に古い内容を書き込まないよう、先に完了を待つ
+            _active_checkpoint.wait()
+        _active_checkpoint = None
         print(f"   ❌ UUID {uuid} の処理でエラーが発生: {e}")
         traceback.print_exc()
         if task_embeddings:
@@ -397,7 +916,8 @@ def main():
     env_vars = [
         "GCS_BUCKET_NAME", "GCP_PROJECT_ID", "GCP_REGION", "VERTEX_MULTIMODAL_MODEL",
         "EMBEDDING_PROVIDER", "COHERE_API_KEY",
-        "UUID", "DRIVE_URL", "USE_EMBED_V4", "BATCH_MODE", "BATCH_TASKS"
+        "UUID", "DRIVE_URL", "USE_EMBED_V4", "BATCH_MODE", "BATCH_TASKS", "MAX_SOURCE_FILE_SIZE_MB",
+        "CLOUD_RUN_TASK_INDEX", "CLOUD_RUN_TASK_COUNT"
     ]
     for var in env_vars:
         value = os.getenv(var, "NOT_SET")
@@ -408,23 +928,35 @@ def main():
         print(f"  {var}: {value}")
     print()
     
+    def signal_handler(signum, frame):
+        print(f"\n⚠️  シグナル {signum} を受信したため、中間結果を保存します...")
+        flush_active_checkpoint()
+        sys.exit(1)
+    
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGINT, signal_handler)
+    
     if BATCH_MODE:
+        # UUIDごとに保存先が独立しているため、タスク単位で分担すれば書き込みが競合しない
+        assigned_tasks = BATCH_TASKS[TASK_INDEX::TASK_COUNT]
         print("===================================================")
         print("  バッチベクトル化ジョブ（差分検出あり）を開始します")
         print(f"  タスク数: {len(BATCH_TASKS)}")
+        if TASK_COUNT > 1:
+            print(f"  並列タスク: {TASK_INDEX + 1}/{TASK_COUNT}（担当 {len(assigned_tasks)} 件）")
         print("  機能: 新規ファイルの自動追加 + 削除ファイルの自動除去")
         print("===================================================")
         
         total_processed = 0
         total_errors = 0
         
-        for i, task in enumerate(BATCH_TASKS, 1):
+        for i, task in enumerate(assigned_tasks, 1):
             uuid = task.get('uuid')
             drive_url = task.get('drive_url')
             company_name = task.get('company_name', '')
             use_embed_v4 = task.get('use_embed_v4', False)
             
-            print(f"\n📋 タスク {i}/{len(BATCH_TASKS)}: {company_name} (UUID: {uuid})")
+            print(f"\n📋 タスク {i}/{len(assigned_tasks)}: {company_name} (UUID: {uuid})")
             
             try:
                 process_single_uuid(uuid, drive_url, use_embed_v4)
@@ -436,8 +968,13 @@ def main():
                 total_errors += 1
                 continue
         
+        sync_embedding_cache()
         print(f"\n🎉 バッチ処理完了: 成功 {total_processed} 件 / 失敗 {total_errors} 件")
     else:
+        if TASK_INDEX > 0:
+            # 単体ジョブは1つの保存先に書き込むため、先頭以外のタスクは何もせずに終了する
+            print(f"ℹ️  単体ジョブはタスク1のみで処理します（このタスク: {TASK_INDEX + 1}/{TASK_COUNT}）")
+            return
         print("===================================================")
         print("  単体ベクトル化ジョブ（差分検出あり）を開始します")
         print(f"  UUID: {UUID}")
@@ -446,22 +983,8 @@ def main():
         print("  機能: 新規ファイルの自動追加 + 削除ファイルの自動除去")
         print("===================================================")
         
-        all_embeddings = []
-        
-        def signal_handler(signum, frame):
-            print(f"\n⚠️  シグナル {signum} を受信したため、中間結果を保存します...")
-            if all_embeddings:
-                try:
-                    save_checkpoint(GCS_BUCKET_NAME, UUID, all_embeddings, is_final=False)
-                    print(f"✅ 緊急保存が完了しました: {len(all_embeddings)} 件")
-                except Exception as e:
-                    print(f"❌ 緊急保存に失敗しました: {e}")
-            sys.exit(1)
-        
-        signal.signal(signal.SIGTERM, signal_handler)
-        signal.signal(signal.SIGINT, signal_handler)
-        
-        all_embeddings = process_single_uuid(UUID, DRIVE_URL, USE_EMBED_V4)
+        process_single_uuid(UUID, DRIVE_URL, USE_EMBED_V4)
+        sync_embedding_cache()
         print("🎉 単体ジョブが正常に終了しました。")
 
 if __name__ == "__main__":
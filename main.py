@@ -41,6 +41,8 @@ class Config:
         self.vertex_multimodal_model = os.getenv("VERTEX_MULTIMODAL_MODEL", "multimodalembedding@001")
         self.embedding_provider = os.getenv("EMBEDDING_PROVIDER", "vertex_ai")
         self.cohere_api_key = os.getenv("COHERE_API_KEY", "")
+        # 検索時のクエリとジョブで作るベクトルの次元をそろえるため、ジョブにも同じ値を渡す
+        self.cohere_v4_output_dimension = os.getenv("COHERE_V4_OUTPUT_DIMENSION", "").strip()
         # Google Sheets ID は環境変数で上書き可能。未指定時は ENVIRONMENT に応じて既定値を選ぶ
         dev_sheets_id = "1xPY1w4q9wm607hNK9Eb0D5v5ub7JFRihx9d-VOpHYOo"
         prod_sheets_id = "1pxSyLLZ-G3U3wwTYNgX_Qzijv7Mzn_6xSRIxGrM9l-4"
@@ -53,8 +55,14 @@ class Config:
         cooldown_value = os.getenv("DRIVE_WATCH_COOLDOWN_SECONDS", "").strip()
         cooldown_seconds = int(cooldown_value or "60")
         self.drive_watch_cooldown_seconds = cooldown_seconds if cooldown_seconds >= 0 else 0
+        debounce_value = os.getenv("DRIVE_WATCH_DEBOUNCE_SECONDS", "").strip()
+        debounce_seconds = float(debounce_value or "1.0")
+        self.drive_watch_debounce_seconds = debounce_seconds if debounce_seconds >= 0 else 0
         verbose_flag = os.getenv("DRIVE_WATCH_VERBOSE_LOGS", "true").strip().lower()
         self.drive_watch_verbose_logs = verbose_flag not in {"false", "0", "no"}
+        # バッチジョブを何タスクに分けて並列実行するか。タスクごとにBATCH_TASKSを分担する
+        batch_task_count_value = os.getenv("VECTORIZE_BATCH_TASK_COUNT", "").strip()
+        self.vectorize_batch_task_count = max(1, int(batch_task_count_value or "1"))
         
         self._validate_required_vars()
     
@@ -163,6 +171,8 @@ class JobService:
         ])
         if self.config.cohere_api_key:
             env_vars.append({"name": "COHERE_API_KEY", "value": self.config.cohere_api_key})
+        if self.config.cohere_v4_output_dimension:
+            env_vars.append({"name": "COHERE_V4_OUTPUT_DIMENSION", "value": self.config.cohere_v4_output_dimension})
         return env_vars
     
     def trigger_vectorization_job(self, uuid: str, drive_url: str, use_embed_v4: bool = False) -> Dict:
@@ -252,6 +262,8 @@ class JobService:
             # Serialize tasks to JSON for passing as environment variable
             import json
             tasks_json = json.dumps([task.dict() for task in tasks])
+            # 各コンテナはCLOUD_RUN_TASK_INDEXに応じてBATCH_TASKSの一部だけを処理する。空のタスクは起動しない
+            task_count = min(self.config.vectorize_batch_task_count, max(1, len(tasks)))
             
             request_object = run_v2.RunJobRequest(
                 name=job_name,
@@ -265,7 +277,8 @@ class JobService:
                                 ]
                             )
                         )
-                    ]
+                    ],
+                    task_count=task_count,
                 )
             )
             
@@ -279,7 +292,7 @@ class JobService:
             else:
                 execution_info = f"Batch job triggered for {len(tasks)} tasks"
             
-            print(f"  -> Batch job execution started. Info: {execution_info}")
+            print(f"  -> Batch job execution started ({task_count} parallel tasks). Info: {execution_info}")
             return {
                 "message": f"Batch vectorization job started successfully for {len(tasks)} tasks",
                 "execution_info": execution_info,
@@ -320,6 +333,7 @@ def get_drive_notification_processor() -> DriveNotificationProcessor:
             job_service=job_service,
             cooldown_seconds=config.drive_watch_cooldown_seconds,
             verbose_logging=config.drive_watch_verbose_logs,
+            debounce_seconds=config.drive_watch_debounce_seconds,
         )
         app.state.drive_notification_processor = processor
     return processor
@@ -448,8 +462,12 @@ async def re_register_drive_channels(request: Optional[ReRegisterRequest] = None
 
 
 @app.post("/drive/notifications", status_code=204)
-async def drive_notifications(request: Request):
-    """Google Drive APIからのpush通知を受信し、必要に応じてジョブを再実行する。"""
+def drive_notifications(request: Request):
+    """
+    Google Drive APIからのpush通知を受信し、必要に応じてジョブを再実行する。
+    連続する通知をまとめるため処理中にデバウンスの窓の間待機するので、イベントループを塞がないよう同期関数として
+    スレッドプールで実行させる（待機中に届いた同じチャネルの通知は並行して受け付け、待機中の読み出しに合流させる）。
+    """
     channel_id = request.headers.get("x-goog-channel-id")
     resource_state = request.headers.get("x-goog-resource-state", "")
     resource_id = request.headers.get("x-goog-resource-id", "")
@@ -524,6 +542,9 @@ class SearchService:
         if normalized in {"vertex-ai", "vertex_ai", "vertex"}:
             return "vertex_ai", False, "vertex-ai"
 
+        if normalized in {"open-clip", "open_clip", "openclip"}:
+            return "open_clip", False, "open-clip"
+
         if normalized in {
             "cohere-embed-v4.0",
             "cohere_embed-v4.0",
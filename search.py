@@ -3,13 +3,15 @@ Google Cloud Storageからベクトルデータを読み込み、類似検索や
 """
 
 import os
-import json
+import threading
 import traceback
 from typing import List, Dict, Optional
 
 import numpy as np
 from google.cloud import storage
 
+from embedding_store import load_store, metadata_blob_name
+
 
 class StorageClient:
     """環境に応じてGoogle Cloud Storageクライアントを初期化するラッパー。"""
@@ -46,6 +48,23 @@ class StorageClient:
         return self._client
 
 
+_shared_storage_client: Optional[StorageClient] = None
+_shared_storage_client_lock = threading.Lock()
+
+
+def get_shared_storage_client() -> StorageClient:
+    """
+    プロセス内で共有するStorageClientを返す（初回のみ生成）。
+    検索リクエストごとにクライアントを作ると、認証情報の取得とGCSへのTLS接続を毎回やり直すことになるため使い回す。
+    """
+    global _shared_storage_client
+    if _shared_storage_client is None:
+        with _shared_storage_client_lock:
+            if _shared_storage_client is None:
+                _shared_storage_client = StorageClient()
+    return _shared_storage_client
+
+
 class ImageSearcher:
     """
     企業ごとのベクトルデータを読み込み、検索処理を提供するクラス。
@@ -72,7 +91,8 @@ class ImageSearcher:
         self.model_name = (model_name or "").strip().lower() or None
         self.embeddings_data: List[Dict] = []
         self.embeddings_matrix: Optional[np.ndarray] = None
-        self.storage_client = StorageClient()
+        self.embedding_norms: Optional[np.ndarray] = None
+        self.storage_client = get_shared_storage_client()
         self._loaded_blob_path: Optional[str] = None
         self.total_entries_count: int = 0
         self.corrupt_entries_count: int = 0
@@ -82,14 +102,15 @@ class ImageSearcher:
 
     def _candidate_blob_paths(self) -> List[str]:
         """
-        現状の運用ではUUIDごとに単一ファイル（{uuid}.json）のみを期待する。
+        現状の運用ではUUIDごとに単一のメタデータファイル（{uuid}.json）のみを期待する。
+        埋め込み行列（{uuid}.npy）は embedding_store がメタデータと組み合わせて読み込む。
         将来的にモデル別パスに拡張する場合はここで分岐を追加する。
         """
-        return [f"{self.uuid}.json"]
+        return [metadata_blob_name(self.uuid)]
 
     def _load_data(self) -> None:
         """
-        GCS上のJSONベクトルファイルを読み込んでメモリに保持する。
+        GCS上のベクトルデータ（メタデータJSONと埋め込み行列）を読み込んでメモリに保持する。
         
         例外:
             FileNotFoundError: ベクトルファイルが存在しない場合
@@ -120,40 +141,44 @@ class ImageSearcher:
         print(f"   📁 Vector source: {file_path}")
 
         try:
-            json_data = blob.download_as_string()
-            raw_data = json.loads(json_data)
+            loaded = load_store(bucket, self.uuid)
+            if loaded is None:
+                raise FileNotFoundError(f"Vector data for UUID '{self.uuid}' not found.")
+            metadata, matrix = loaded
 
-            if not isinstance(raw_data, list):
-                raise ValueError("Vector file format is invalid. Expected a list of entries.")
-
-            self.total_entries_count = len(raw_data)
+            self.total_entries_count = len(metadata)
             self.corrupt_entries_count = 0
             self.invalid_entries_count = 0
 
             filtered_items: List[Dict] = []
-            embeddings_list: List[List[float]] = []
+            rows: List[int] = []
 
-            for item in raw_data:
+            for item in metadata:
                 if item.get("is_corrupt"):
                     self.corrupt_entries_count += 1
                     continue
-                embedding = item.get("embedding")
-                if not embedding:
+                row = item.get("embedding_index")
+                if row is None:
                     self.invalid_entries_count += 1
                     continue
                 filtered_items.append(item)
-                embeddings_list.append(embedding)
-
-            self.embeddings_data = filtered_items
+                rows.append(row)
 
-            if embeddings_list:
-                # Create a NumPy matrix from the embeddings for efficient calculation
-                self.embeddings_matrix = np.array(embeddings_list, dtype=np.float32)
-                print(f"✅ Successfully loaded and processed {len(self.embeddings_data)} vectors.")
+            if filtered_items:
+                # Keep only the rows referenced by valid entries, in entry order
+                if rows != list(range(matrix.shape[0])):
+                    matrix = matrix[rows]
+                self.embeddings_matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+                # Row norms never change after loading, so compute them once rather than per query
+                self.embedding_norms = np.linalg.norm(self.embeddings_matrix, axis=1)
+                print(f"✅ Successfully loaded and processed {len(filtered_items)} vectors.")
             else:
                 self.embeddings_matrix = np.array([], dtype=np.float32)
+                self.embedding_norms = np.array([], dtype=np.float32)
                 print("⚠️  Warning: No valid embeddings available after filtering.")
 
+            self.embeddings_data = filtered_items
+
             if self.corrupt_entries_count:
                 print(f"   ⚠️ Skipped {self.corrupt_entries_count} entries marked as corrupt.")
             if self.invalid_entries_count:
@@ -210,13 +235,19 @@ class ImageSearcher:
             
             print(f"   Search candidates: {len(valid_indices)} (excluded {excluded_count} files)")
             
-            # Create filtered embeddings matrix from valid candidates only
-            filtered_embeddings = self.embeddings_matrix[valid_indices]
+            if excluded_count:
+                # Create filtered embeddings matrix from valid candidates only
+                filtered_embeddings = self.embeddings_matrix[valid_indices]
+                filtered_norms = self.embedding_norms[valid_indices]
+            else:
+                # Nothing excluded: use the loaded matrix as-is instead of copying every row per query
+                filtered_embeddings = self.embeddings_matrix
+                filtered_norms = self.embedding_norms
             
             # Calculate cosine similarity only for valid candidates
-            similarities = np.dot(filtered_embeddings, query_embedding) / (
-                np.linalg.norm(filtered_embeddings, axis=1) * np.linalg.norm(query_embedding)
-            )
+            query_embedding = np.asarray(query_embedding, dtype=np.float32)
+            similarities = filtered_embeddings @ query_embedding
+            similarities /= filtered_norms * np.linalg.norm(query_embedding)
             
             # Get top-n indices sorted by similarity (descending) for the pool
             pool_size = min(top_n_pool, len(similarities))
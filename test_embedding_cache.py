@@ -0,0 +1,129 @@
+"""
+embedding_cache.EmbeddingCache のテスト。
+
+GCSとの同期はバケットとオブジェクトの最小限の偽物を使って確認する。
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from google.api_core.exceptions import PreconditionFailed
+
+import embedding_cache
+from embedding_cache import EmbeddingCache
+
+
+class _FakeBlob:
+    def __init__(self, bucket: "_FakeBucket") -> None:
+        self._bucket = bucket
+        self.generation = None
+
+    def upload_from_filename(self, path, content_type=None, if_generation_match=None):
+        self._bucket.upload_generations.append(if_generation_match)
+        if self._bucket.conflicts:
+            self._bucket.conflicts -= 1
+            raise PreconditionFailed("generation mismatch")
+        self._bucket.generation += 1
+        self.generation = self._bucket.generation
+
+    def download_to_filename(self, path):
+        shutil.copyfile(self._bucket.remote_path, path)
+        self.generation = self._bucket.generation
+
+
+class _FakeBucket:
+    """upload_from_filenameを指定回数だけ世代の不一致で失敗させるバケット。"""
+
+    def __init__(self, remote_path: str, conflicts: int, generation: int) -> None:
+        self.remote_path = remote_path
+        self.conflicts = conflicts
+        self.generation = generation
+        self.upload_generations = []
+
+    def blob(self, name):
+        return _FakeBlob(self)
+
+
+class EmbeddingCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._temp_dir.cleanup)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._temp_dir.name, name)
+
+    def _open(self, name: str) -> EmbeddingCache:
+        cache = EmbeddingCache(self._path(name))
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_get_many_queries_in_chunks(self) -> None:
+        cache = self._open("local.sqlite3")
+        vectors = {f"key-{i}": np.full(4, i, dtype=np.float32) for i in range(7)}
+        cache.put_many(vectors.items())
+
+        statements = []
+        cache._conn.set_trace_callback(statements.append)
+        with mock.patch.object(embedding_cache, "QUERY_BATCH_SIZE", 3):
+            found = cache.get_many(list(vectors) + ["missing", "key-0"])
+
+        # 重複を除いた8件を3件ずつ問い合わせる
+        self.assertEqual(sum(statement.startswith("SELECT") for statement in statements), 3)
+        self.assertEqual(set(found), set(vectors))
+        for key, vector in vectors.items():
+            np.testing.assert_array_equal(found[key], vector)
+        self.assertEqual(cache.stats(), {"hits": 0, "misses": 0})
+
+    def test_merge_from_file_without_file_hashes_table(self) -> None:
+        old_path = self._path("old.sqlite3")
+        conn = sqlite3.connect(old_path)
+        conn.execute("CREATE TABLE embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        conn.execute(
+            "INSERT INTO embeddings (key, vector) VALUES (?, ?)",
+            ("remote", np.ones(3, dtype=np.float32).tobytes()),
+        )
+        conn.commit()
+        conn.close()
+
+        cache = self._open("local.sqlite3")
+        cache.put_file_hashes([("md5", "hash")])
+        cache.merge_from(old_path)
+
+        np.testing.assert_array_equal(cache.get("remote"), np.ones(3, dtype=np.float32))
+        self.assertEqual(cache.get_file_hashes(["md5"]), {"md5": "hash"})
+
+    def test_upload_merges_remote_and_retries_on_precondition_failed(self) -> None:
+        remote = self._open("remote.sqlite3")
+        remote.put_many([("remote", np.ones(2, dtype=np.float32))])
+        remote.put_file_hashes([("remote-md5", "remote-hash")])
+        remote.close()
+
+        cache = self._open("local.sqlite3")
+        cache.put_many([("local", np.zeros(2, dtype=np.float32))])
+        bucket = _FakeBucket(self._path("remote.sqlite3"), conflicts=1, generation=5)
+
+        cache.upload(bucket, "cache.sqlite3")
+
+        self.assertEqual(bucket.upload_generations, [0, 5])
+        self.assertEqual(cache.remote_generation, 6)
+        self.assertEqual(set(cache.get_many(["local", "remote"])), {"local", "remote"})
+        self.assertEqual(cache.get_file_hashes(["remote-md5"]), {"remote-md5": "remote-hash"})
+
+    def test_upload_gives_up_after_repeated_conflicts(self) -> None:
+        remote = self._open("remote.sqlite3")
+        remote.close()
+        cache = self._open("local.sqlite3")
+        bucket = _FakeBucket(self._path("remote.sqlite3"), conflicts=embedding_cache.UPLOAD_MAX_ATTEMPTS, generation=1)
+
+        with self.assertRaises(RuntimeError):
+            cache.upload(bucket, "cache.sqlite3")
+        self.assertEqual(len(bucket.upload_generations), embedding_cache.UPLOAD_MAX_ATTEMPTS)
+
+
+if __name__ == "__main__":
+    unittest.main()
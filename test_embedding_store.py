@@ -0,0 +1,185 @@
+"""
+embedding_store の保存形式（npy行列・差分チェックポイント・整合性の確認）のテスト。
+
+GCSの代わりに、オブジェクトをメモリ上に持つ最小限の偽物のバケットを使う。
+"""
+
+import contextlib
+import gzip
+import io
+import unittest
+from typing import Dict, List, Optional
+from unittest import mock
+
+import numpy as np
+from google.api_core.exceptions import NotFound
+
+import embedding_store
+from embedding_store import load_records, load_store, save_part, save_records
+
+
+class _FakeBlob:
+    def __init__(self, bucket: "_FakeBucket", name: str) -> None:
+        self._bucket = bucket
+        self.name = name
+        self.metadata: Optional[Dict[str, str]] = None
+        self.content_encoding: Optional[str] = None
+
+    def exists(self) -> bool:
+        return self.name in self._bucket.objects
+
+    def upload_from_string(self, data, content_type=None) -> None:
+        self._bucket.objects[self.name] = (bytes(data), self.metadata, self.content_encoding)
+
+    def download_as_bytes(self) -> bytes:
+        if self.name not in self._bucket.objects:
+            raise NotFound(self.name)
+        stale = self._bucket.stale_downloads.get(self.name)
+        if stale:
+            return stale.pop(0)
+        data, _, encoding = self._bucket.objects[self.name]
+        # GCSはgzipを受け付けないクライアントには展開して返す
+        return gzip.decompress(data) if encoding == "gzip" else data
+
+    def open(self, mode: str, **kwargs) -> "_FakeWriter":
+        return _FakeWriter(self)
+
+    def delete(self) -> None:
+        del self._bucket.objects[self.name]
+
+
+class _FakeWriter(io.BytesIO):
+    """blob.open("wb") の代わり。閉じた時点で内容をアップロードする。"""
+
+    def __init__(self, blob: _FakeBlob) -> None:
+        super().__init__()
+        self._blob = blob
+
+    def close(self) -> None:
+        if not self.closed:
+            self._blob.upload_from_string(self.getvalue())
+        super().close()
+
+
+class _FakeClient:
+    def batch(self):
+        return contextlib.nullcontext()
+
+
+class _FakeBucket:
+    def __init__(self) -> None:
+        self.objects: Dict[str, tuple] = {}
+        # オブジェクト名 -> 次回以降のダウンロードで本来の内容の代わりに返すバイト列（書き込み途中の読み込みを模す）
+        self.stale_downloads: Dict[str, List[bytes]] = {}
+        self.client = _FakeClient()
+
+    def blob(self, name: str) -> _FakeBlob:
+        return _FakeBlob(self, name)
+
+    def get_blob(self, name: str) -> Optional[_FakeBlob]:
+        if name not in self.objects:
+            return None
+        blob = _FakeBlob(self, name)
+        blob.metadata = self.objects[name][1]
+        return blob
+
+    def list_blobs(self, prefix: str = "") -> List[_FakeBlob]:
+        return [_FakeBlob(self, name) for name in sorted(self.objects) if name.startswith(prefix)]
+
+
+def _records(start: int, count: int, dim: int = 8) -> List[dict]:
+    rng = np.random.default_rng(start)
+    return [
+        {"filename": f"{index}.jpg", "embedding": rng.normal(size=dim).astype(np.float32)}
+        for index in range(start, start + count)
+    ]
+
+
+class EmbeddingStoreTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.bucket = _FakeBucket()
+
+    def _assert_round_trip(self, records: List[dict], atol: float) -> None:
+        loaded = load_records(self.bucket, "uuid")
+        self.assertEqual([item["filename"] for item in loaded], [item["filename"] for item in records])
+        for item, record in zip(loaded, records):
+            self.assertEqual(item["embedding"].dtype, np.float32)
+            np.testing.assert_allclose(item["embedding"], record["embedding"], atol=atol)
+
+    def test_float16_round_trip(self) -> None:
+        records = _records(0, 5)
+        with mock.patch.object(embedding_store, "STORAGE_DTYPE", np.dtype(np.float16)):
+            save_records(self.bucket, "uuid", records)
+        matrix = np.load(io.BytesIO(self.bucket.objects["uuid.npy"][0]))
+        self.assertEqual(matrix.dtype, np.float16)
+        self._assert_round_trip(records, atol=1e-2)
+
+    def test_float16_streaming_round_trip(self) -> None:
+        records = _records(0, 40)
+        with mock.patch.object(embedding_store, "STORAGE_DTYPE", np.dtype(np.float16)), \
+                mock.patch.object(embedding_store, "STREAMING_UPLOAD_THRESHOLD_BYTES", 64), \
+                mock.patch.object(embedding_store, "UPLOAD_ROW_BLOCK", 16):
+            save_records(self.bucket, "uuid", records)
+        self._assert_round_trip(records, atol=1e-2)
+
+    def test_int8_round_trip(self) -> None:
+        records = _records(0, 5)
+        records.append({"filename": "zero.jpg", "embedding": np.zeros(8, dtype=np.float32)})
+        with mock.patch.object(embedding_store, "STORAGE_DTYPE", np.dtype(np.int8)):
+            save_records(self.bucket, "uuid", records)
+        self._assert_round_trip(records, atol=2e-2)
+
+    def test_rows_without_embedding_keep_their_position(self) -> None:
+        records = _records(0, 2)
+        records.insert(1, {"filename": "broken.jpg", "embedding": None, "is_corrupt": True})
+        save_records(self.bucket, "uuid", records)
+        loaded = load_records(self.bucket, "uuid")
+        self.assertIsNone(loaded[1]["embedding"])
+        np.testing.assert_allclose(loaded[2]["embedding"], records[2]["embedding"], atol=1e-2)
+
+    def test_parts_are_appended_only_while_contiguous(self) -> None:
+        save_records(self.bucket, "uuid", _records(0, 3))
+        save_part(self.bucket, "uuid", 3, _records(3, 2))
+        # 5件目までしか無いため、開始位置が7の差分とそれ以降は使わない
+        save_part(self.bucket, "uuid", 7, _records(7, 1))
+        save_part(self.bucket, "uuid", 8, _records(8, 1))
+
+        metadata, matrix = load_store(self.bucket, "uuid")
+        self.assertEqual([item["filename"] for item in metadata], [f"{index}.jpg" for index in range(5)])
+        self.assertEqual([item["embedding_index"] for item in metadata], list(range(5)))
+        self.assertEqual(matrix.shape, (5, 8))
+
+    def test_save_records_removes_parts(self) -> None:
+        save_records(self.bucket, "uuid", _records(0, 3))
+        save_part(self.bucket, "uuid", 3, _records(3, 2))
+        save_records(self.bucket, "uuid", _records(0, 5))
+        self.assertEqual(sorted(self.bucket.objects), ["uuid.json", "uuid.npy"])
+
+    def test_load_single_rereads_after_row_count_mismatch(self) -> None:
+        save_records(self.bucket, "uuid", _records(0, 2))
+        stale_matrix = self.bucket.objects["uuid.npy"][0]
+        records = _records(0, 3)
+        save_records(self.bucket, "uuid", records)
+        # チェックサムを持たない以前の保存では件数だけで確かめる
+        data, _, encoding = self.bucket.objects["uuid.json"]
+        self.bucket.objects["uuid.json"] = (data, None, encoding)
+        self.bucket.stale_downloads["uuid.npy"] = [stale_matrix]
+
+        metadata, matrix = load_store(self.bucket, "uuid")
+        self.assertEqual(self.bucket.stale_downloads["uuid.npy"], [])
+        self.assertEqual(len(metadata), 3)
+        self.assertEqual(matrix.shape, (3, 8))
+
+    def test_load_single_rejects_matrix_from_another_save(self) -> None:
+        # 件数が同じでも、JSONに付けたチェックサムと異なる行列は組み合わせない
+        save_records(self.bucket, "uuid", _records(100, 3))
+        other_matrix = self.bucket.objects["uuid.npy"][0]
+        save_records(self.bucket, "uuid", _records(0, 3))
+        self.bucket.stale_downloads["uuid.npy"] = [other_matrix, other_matrix]
+
+        with self.assertRaises(ValueError):
+            load_store(self.bucket, "uuid")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,13 @@
+"""
+ベクトル化ジョブ（img_meta_processor_gdrive.main）の起動用スクリプト。
+
+画像のリサイズはspawnで起動したプロセスプールで行うが、spawnのワーカーは起動時に親の__main__モジュールを
+__mp_main__として読み込み直す。ジョブ本体を直接実行すると、ワーカーごとに環境変数の検証やload_dotenv、
+GCSクライアントの作成、atexitの登録までが繰り返される。このスクリプトは本体のimportをmainガードの内側で行うため、
+ワーカーが読み込むのはこのファイルと、投入された関数を持つimage_resizerだけになる。
+"""
+
+if __name__ == "__main__":
+    from img_meta_processor_gdrive import main
+
+    main()